@@ -0,0 +1,502 @@
+#! /usr/bin/env python2.7
+#
+#   columnar.py
+#
+#   A compact, column oriented file format for packetsummary output, written
+#   incrementally and read back through mmap without parsing the whole file.
+#
+#   Rows are appended to named tables and buffered per column. Every CHUNK_ROWS
+#   rows a table's buffer is written out as one chunk, each column as a typed
+#   array (int64, float64, bool, or uint32 ids into a shared string table). Strings
+#   are interned once per file, so repeated hosts, domains and keys cost 4 bytes a row.
+#   Values that aren't scalars (lists, dicts) are stored as interned JSON text.
+#
+#   Layout:
+#
+#       MAGIC
+#       block*          kind (1 byte), payload length (uint64), payload
+#                           'S'  strings: count, lengths[count], bytes
+#                           'C'  chunk: table, rows, columns, then per column
+#                                name, type, has nulls, values[rows], nulls[rows]
+#       footer          JSON: tables -> [[chunk offset, rows]], string blocks, byte order, meta
+#       trailer         footer offset (uint64), END
+#
+#   eg:
+#       with ColumnarWriter('out.psc') as w:
+#           w.append('http', {'host' : 'example.com', 'port' : 80})
+#
+#       f = ColumnarFile('out.psc')
+#       f.table('http').column('host')
+
+# Standard Lib
+import sys
+import json
+import mmap
+import array
+import struct
+
+
+MAGIC           =   'PSCOL\x00\x01\x00'
+END             =   'PSCOLEND'
+CHUNK_ROWS      =   4096
+
+# Column type -> (array typecode, item size, struct code). The array typecode is
+# whatever native type has that size; the struct code is the standard-size one,
+# used with an explicit byte order ('<l' would be 4 bytes, not 8)
+TYPES           =   {
+    'q'         :   ('l' if array.array('l').itemsize == 8 else 'q', 8, 'q'),
+    'd'         :   ('d', 8, 'd'),
+    'b'         :   ('B', 1, 'B'),
+    's'         :   ('I', 4, 'I'),
+    'j'         :   ('I', 4, 'I'),
+}
+
+NO_STRING       =   0xffffffff
+INT64           =   (-(1 << 63), (1 << 63) - 1)
+
+
+def flatten(record, prefix = ''):
+    """
+    One level of nesting is folded into dotted column names: {'a' : {'b' : 1}} -> {'a.b' : 1}
+    Anything deeper stays as a value (and is stored as JSON)
+    """
+
+    flat = {}
+
+    for key, value in record.iteritems():
+        if isinstance(value, dict) and not prefix:
+            flat.update(flatten(value, key + '.'))
+        else:
+            flat[prefix + key] = value
+
+    return flat
+
+
+def _column_type(values):
+    """
+    Narrowest column type that holds every (non-None) value
+    """
+
+    kinds = set(type(v) for v in values if v is not None)
+
+    if not kinds:
+        return 'q'
+    if kinds == set([bool]):
+        return 'b'
+    if kinds <= set([int, long]):
+        if all(INT64[0] <= v <= INT64[1] for v in values if v is not None):
+            return 'q'
+        return 'j'
+    if kinds <= set([int, long, float]):
+        return 'd'
+    if kinds <= set([str, unicode]):
+        return 's'
+    return 'j'
+
+
+class ColumnarWriter(object):
+    """
+    Append rows (dicts) to named tables; chunks go to disk as they fill up
+    Raises an exception if the file can't be written
+    """
+
+    def __init__(self, path = None, chunk_rows = CHUNK_ROWS):
+
+        try:
+            self.handle     =   open(path, 'wb')
+        except(IOError, OSError):
+            raise Exception("Unable to write {0}".format(path))
+
+        self.handle.write(MAGIC)
+
+        self.chunkRows      =   chunk_rows
+
+        # table -> (rows buffered, column -> values)
+        self.tables         =   {}
+        self.chunks         =   {}
+
+        # Interned strings, and those not yet on disk
+        self.strings        =   {}
+        self.pending        =   []
+        self.stringBlocks   =   []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    def _intern(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        ident = self.strings.get(value)
+        if ident is None:
+            ident = self.strings[value] = len(self.strings)
+            self.pending.append(value)
+        return ident
+
+    def append(self, table = None, row = None):
+        """
+        Add one row. Columns may come and go between rows; gaps are nulls
+        """
+
+        rows, columns = self.tables.get(table, (0, None))
+        if columns is None:
+            columns = {}
+
+        for name, value in row.iteritems():
+            values = columns.get(name)
+            if values is None:
+                values = columns[name] = [None] * rows
+            values.append(value)
+
+        rows += 1
+
+        # Columns this row didn't have
+        for values in columns.itervalues():
+            if len(values) < rows:
+                values.append(None)
+
+        self.tables[table] = (rows, columns)
+
+        if rows >= self.chunkRows:
+            self._flush(table)
+
+    def _block(self, kind, payload):
+        offset = self.handle.tell()
+        self.handle.write(kind + struct.pack('<Q', len(payload)))
+        self.handle.write(payload)
+        return offset
+
+    def _flush(self, table):
+        """
+        Write out a table's buffered rows as one chunk
+        """
+
+        rows, columns = self.tables.pop(table, (0, None))
+        if not rows:
+            return
+
+        parts = []
+
+        for name, values in sorted(columns.iteritems()):
+            kind = _column_type(values)
+            code = TYPES[kind][0]
+
+            if kind in ('s', 'j'):
+                encode = (lambda v: v) if kind == 's' else (lambda v: json.dumps(v, sort_keys = True))
+                data = array.array(code, [NO_STRING if v is None else self._intern(encode(v)) for v in values])
+            elif kind == 'b':
+                data = array.array(code, [1 if v else 0 for v in values])
+            elif kind == 'd':
+                data = array.array(code, [0.0 if v is None else float(v) for v in values])
+            else:
+                data = array.array(code, [0 if v is None else v for v in values])
+
+            nulls = None
+            if kind not in ('s', 'j') and None in values:
+                nulls = array.array('B', [v is None for v in values])
+
+            parts.append(struct.pack('<IcB', self._intern(name), kind, 1 if nulls is not None else 0))
+            parts.append(data.tostring())
+            if nulls is not None:
+                parts.append(nulls.tostring())
+
+        # Any strings this chunk refers to go first
+        if self.pending:
+            payload = struct.pack('<I', len(self.pending)) + array.array('I', [len(s) for s in self.pending]).tostring() + ''.join(self.pending)
+            self.stringBlocks.append(self._block('S', payload))
+            del self.pending[:]
+
+        header = struct.pack('<III', self._intern(table), rows, len(columns))
+
+        # The table name may itself be new
+        if self.pending:
+            payload = struct.pack('<I', len(self.pending)) + array.array('I', [len(s) for s in self.pending]).tostring() + ''.join(self.pending)
+            self.stringBlocks.append(self._block('S', payload))
+            del self.pending[:]
+
+        offset = self._block('C', header + ''.join(parts))
+        self.chunks.setdefault(table, []).append([offset, rows])
+
+    def close(self, meta = None):
+        """
+        Flush every table and write the footer. meta (JSON-able) is stored as is
+        """
+
+        if self.handle is None:
+            return
+
+        for table in sorted(self.tables):
+            self._flush(table)
+
+        footer = json.dumps({
+            'tables'    :   self.chunks,
+            'strings'   :   self.stringBlocks,
+            'byteorder' :   sys.byteorder,
+            'meta'      :   meta,
+        })
+
+        offset = self.handle.tell()
+        self.handle.write(footer)
+        self.handle.write(struct.pack('<Q', offset) + END)
+        self.handle.close()
+        self.handle = None
+
+
+class Column(object):
+    """
+    One column of one chunk, read in place from the map
+    """
+
+    def __init__(self, owner, kind, offset, rows, nulls):
+        self.owner      =   owner
+        self.kind       =   kind
+        self.offset     =   offset
+        self.rows       =   rows
+        self.nulls      =   nulls
+        self.format     =   owner.endian + TYPES[kind][2]
+        self.size       =   TYPES[kind][1]
+
+    def __len__(self):
+        return self.rows
+
+    def raw(self):
+        """
+        The column's stored values as an array (string columns give string ids)
+        """
+
+        data = array.array(TYPES[self.kind][0])
+        data.fromstring(self.owner.map[self.offset:self.offset + self.rows * self.size])
+        if self.owner.swap:
+            data.byteswap()
+        return data
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.rows:
+            raise IndexError(index)
+
+        if self.nulls is not None and self.owner.map[self.nulls + index] != '\x00':
+            return None
+
+        value, = struct.unpack_from(self.format, self.owner.map, self.offset + index * self.size)
+        return self._decode(value)
+
+    def _decode(self, value):
+        if self.kind == 's':
+            return None if value == NO_STRING else self.owner.string(value)
+        if self.kind == 'j':
+            return None if value == NO_STRING else json.loads(self.owner.string(value))
+        if self.kind == 'b':
+            return bool(value)
+        return value
+
+    def __iter__(self):
+        nulls = self.owner.map[self.nulls:self.nulls + self.rows] if self.nulls is not None else None
+
+        for index, value in enumerate(self.raw()):
+            if nulls is not None and nulls[index] != '\x00':
+                yield None
+            else:
+                yield self._decode(value)
+
+
+class Table(object):
+    """
+    Every chunk of one table
+    """
+
+    def __init__(self, owner, chunks):
+        self.owner      =   owner
+        self.chunks     =   [owner._chunk(offset) for offset, rows in chunks]
+        self.rows       =   sum(rows for offset, rows in chunks)
+
+    def __len__(self):
+        return self.rows
+
+    def columns(self):
+        names = []
+        for rows, columns in self.chunks:
+            for name in columns:
+                if name not in names:
+                    names.append(name)
+        return names
+
+    def column(self, name = None):
+        """
+        Every value of a column, in row order (None where a chunk lacks it)
+        """
+
+        for rows, columns in self.chunks:
+            column = columns.get(name)
+            if column is None:
+                for i in xrange(rows):
+                    yield None
+            else:
+                for value in column:
+                    yield value
+
+    def rows_where(self, name = None, value = None):
+        """
+        Indexes of rows whose column equals value. String columns are matched on
+        their interned id, so no string is decoded
+        """
+
+        ident = self.owner.lookup(value) if isinstance(value, basestring) else None
+        base = 0
+
+        for rows, columns in self.chunks:
+            column = columns.get(name)
+
+            if column is not None:
+                if column.kind == 's':
+                    if ident is not None:
+                        for index, stored in enumerate(column.raw()):
+                            if stored == ident:
+                                yield base + index
+                else:
+                    for index, stored in enumerate(column):
+                        if stored == value:
+                            yield base + index
+
+            base += rows
+
+    def __iter__(self):
+        """
+        Rows as dicts (nulls left out)
+        """
+
+        for rows, columns in self.chunks:
+            values = dict((name, list(column)) for name, column in columns.iteritems())
+            for index in xrange(rows):
+                yield dict((name, column[index]) for name, column in values.iteritems() if column[index] is not None)
+
+
+class ColumnarFile(object):
+    """
+    mmap a file written by ColumnarWriter. Only the footer is parsed up front;
+    chunks and strings are read where they lie as they're asked for
+    Raises an exception if it isn't one of ours
+    """
+
+    def __init__(self, path = None):
+
+        try:
+            self.handle     =   open(path, 'rb')
+            self.map        =   mmap.mmap(self.handle.fileno(), 0, access = mmap.ACCESS_READ)
+        except(IOError, OSError, ValueError, mmap.error):
+            raise Exception("Unable to open {0}".format(path))
+
+        size = len(self.map)
+
+        if size < len(MAGIC) + 16 or self.map[:len(MAGIC)] != MAGIC or self.map[size - len(END):] != END:
+            self.close()
+            raise Exception("{0} isn't a columnar summary (or wasn't closed)".format(path))
+
+        offset, = struct.unpack_from('<Q', self.map, size - 16)
+
+        try:
+            footer = json.loads(self.map[offset:size - 16])
+        except ValueError:
+            self.close()
+            raise Exception("{0} has a corrupt footer".format(path))
+
+        self.path       =   path
+        self.meta       =   footer['meta']
+        self.endian     =   '<' if footer['byteorder'] == 'little' else '>'
+        self.swap       =   footer['byteorder'] != sys.byteorder
+        self._tables    =   footer['tables']
+
+        # String id -> (offset, length), built from the string blocks' length arrays
+        self._offsets   =   array.array('L')
+        self._lengths   =   array.array('I')
+        self._ids       =   None
+
+        for block in footer['strings']:
+            count, = struct.unpack_from('<I', self.map, block + 9)
+            lengths = array.array('I')
+            lengths.fromstring(self.map[block + 13:block + 13 + count * 4])
+            if self.swap:
+                lengths.byteswap()
+
+            position = block + 13 + count * 4
+            for length in lengths:
+                self._offsets.append(position)
+                self._lengths.append(length)
+                position += length
+
+    def tables(self):
+        return sorted(self._tables)
+
+    def table(self, name = None):
+        return Table(self, self._tables.get(name, []))
+
+    def string(self, ident):
+        offset = self._offsets[ident]
+        return self.map[offset:offset + self._lengths[ident]]
+
+    def lookup(self, value = None):
+        """
+        Interned id of a string, or None if this file never saw it
+        """
+
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        if self._ids is None:
+            self._ids = dict((self.string(i), i) for i in xrange(len(self._offsets)))
+
+        return self._ids.get(value)
+
+    def _chunk(self, offset):
+        """
+        (rows, {column : Column}) for the chunk block at offset
+        """
+
+        m = self.map
+        table, rows, count = struct.unpack_from('<III', m, offset + 9)
+        position = offset + 21
+        columns = {}
+
+        for i in xrange(count):
+            name, kind, nulls = struct.unpack_from('<IcB', m, position)
+            position += 6
+
+            data = position
+            position += rows * TYPES[kind][1]
+
+            mask = None
+            if nulls:
+                mask = position
+                position += rows
+
+            columns[self.string(name)] = Column(self, kind, data, rows, mask)
+
+        return rows, columns
+
+    def close(self):
+        if getattr(self, 'map', None) is not None:
+            self.map.close()
+            self.map = None
+        self.handle.close()
+
+
+def find(paths = None, table = None, column = None, value = None):
+    """
+    Yield (path, row index) for every row across many files where column == value
+    Files that never interned a string value are skipped without touching their chunks
+    """
+
+    for path in paths:
+        summary = ColumnarFile(path)
+
+        try:
+            if isinstance(value, basestring) and summary.lookup(value) is None:
+                continue
+
+            for index in summary.table(table).rows_where(column, value):
+                yield path, index
+
+        finally:
+            summary.close()
@@ -8,66 +8,560 @@
 #
 #   NOTE: DON'T USE THIS IN PRODUCTION. This was a demo/learning experience. It's published here in hopes someone will find it  useful
 #
-# Returns 1 if the file doesn't havea a DOS header
-# Returns 2 if file couldn't be read
+# Returns None if the file doesn't have a DOS/PE header or couldn't be read
 # Returns the data in epoch or formatted otherwise
+#
+# Bulk use: scanPaths() walks directory trees and yields (path, epoch) from a thread pool,
+#   reading one header page per file. Run as a script to stream CSV or NDJSON, eg:
+#
+#   getPETimestamp.py /corpus --format ndjson --workers 32 --output stamps.ndjson
+#
+# parsePE() goes further: machine, sections, imphash, debug directory and Rich header,
+#   decoded in place from an mmap so only the pages holding headers are ever touched (--full)
+#
+# Pass a ResultCache as cache to parsePE() to skip files we've already parsed. scanPaths() also
+#   takes the path to one, and opens it once for the whole scan (--full --cache). Timestamps
+#   aren't cached: reading one page of the file is cheaper than any lookup
 
-from struct import unpack
-from binascii import hexlify
+import os
+import csv
+import stat
+import json
+import mmap
+import hashlib
+from struct import unpack_from, error as StructError
 from time import gmtime, strftime
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
-def getEpoch(filePath, epoch = True):
+from resultcache import ResultCache
+
+# The scandir backport tells regular files apart without a stat() per entry; os.walk
+# and a stat() each do the same job, slower
+try:
+    from scandir import scandir
+except ImportError:
+    from os import walk
+    scandir = None
+
+# One read covers the DOS header and, for nearly every file, the PE header after it
+HEADER_PAGE =   4096
+
+# scanPaths() hands the pool this many paths at a time, so a huge tree is never queued up whole
+SCAN_BATCH  =   4096
+
+# e_lfanew lives at 60 in the DOS header; TimeDateStamp is 8 bytes into the PE header
+LFANEW      =   60
+STAMP       =   8
+
+MACHINES    =   {
+    0x014c  :   'i386',
+    0x0166  :   'mips',
+    0x01c0  :   'arm',
+    0x01c4  :   'armnt',
+    0x0200  :   'ia64',
+    0x8664  :   'amd64',
+    0xaa64  :   'arm64',
+}
+
+DEBUG_TYPES =   {
+    1       :   'coff',
+    2       :   'codeview',
+    3       :   'fpo',
+    4       :   'misc',
+    9       :   'borland',
+    12      :   'vc_feature',
+    13      :   'pogo',
+    14      :   'iltcg',
+    16      :   'repro',
+    20      :   'ex_dllcharacteristics',
+}
+
+# Optional header magic -> (name, thunk size, offset of the data directories)
+OPTIONAL    =   {
+    0x10b   :   ('PE32', 4, 96),
+    0x20b   :   ('PE32+', 8, 112),
+}
+
+# Sanity caps, so a hostile header can't send us looping over the whole file
+MAX_SECTIONS    =   96
+MAX_IMPORTS     =   4096
+MAX_THUNKS      =   65536
+MAX_DEBUG       =   64
+MAX_NAME        =   512
+
+RICH_DANS   =   0x536e6144
+
+# Bump when parsing changes, so cached results from the old code aren't served
+CACHE_VERSION   =   1
+
+
+def readTimestamp(handle):
+    """
+    TimeDateStamp from an open file, or None if it isn't a PE
+    Reads the first header page, plus 12 more bytes if e_lfanew points past it
+    """
+
+    header = handle.read(HEADER_PAGE)
+
+    if len(header) < LFANEW + 4 or header[:2] != 'MZ':
+        return
+
+    # Little-endian DWORD, read straight out of the buffer
+    offset = unpack_from('<L', header, LFANEW)[0]
+
+    if offset + STAMP + 4 > len(header):
+        handle.seek(offset, 0)
+        header = handle.read(STAMP + 4)
+        offset = 0
 
-    # Open the file in Binary mode
     try:
-        handle = open(filePath, 'rb')
-        if hexlify(handle.read(2)) != hexlify(u'MZ'):
-            handle.close()
+        if header[offset:offset + 4] != 'PE\x00\x00':
             return
-    except:
+        return unpack_from('<L', header, offset + STAMP)[0]
+
+    # Truncated after e_lfanew
+    except StructError:
         return
 
-    try:
-        # Get PE offset (@60, DWORD) from DOS header
-        #   It's little-endian so we have to flip it
-        #   We also need the HEX representation which is an INT value
-        handle.seek(60, 0)
-        offset = handle.read(4)
-        offset = hexlify(offset[::-1])
-
-        # This was added in due to an issue with offset being set to '' on rare occasions (see comments below)
-        if offset == '':
-            handle.close()
+
+def _fits(m, offset, size):
+    return 0 <= offset and offset + size <= len(m)
+
+
+def _cstring(m, offset, limit = MAX_NAME):
+    """
+    NUL terminated string at offset, or None if it runs off the end (or past limit)
+    """
+    if not _fits(m, offset, 1):
+        return
+    end = m.find('\x00', offset, offset + limit)
+    if end < 0:
+        return
+    return m[offset:end]
+
+
+def _rvaToOffset(rva, sections, headers):
+    """
+    File offset of a relative virtual address, or None if no section maps it
+    """
+    if rva < headers:
+        return rva
+
+    for s in sections:
+        if s['virtual_address'] <= rva < s['virtual_address'] + max(s['virtual_size'], s['raw_size']):
+            return rva - s['virtual_address'] + s['raw_offset']
+
+
+def _rich(m, lfanew):
+    """
+    Decoded Rich header (between the DOS stub and the PE header), or None
+    """
+    end = m.rfind('Rich', 0x80, lfanew)
+    if end < 0 or not _fits(m, end, 8):
+        return
+
+    key = unpack_from('<L', m, end + 4)[0]
+
+    # Walk back to the XORed 'DanS' marker
+    start = end - 4
+    while start >= 0x80 and unpack_from('<L', m, start)[0] ^ key != RICH_DANS:
+        start -= 4
+    if start < 0x80:
+        return
+
+    # DanS is followed by three padding DWORDs, then (comp id, count) pairs
+    entries = []
+    for offset in xrange(start + 16, end, 8):
+        compid, count = unpack_from('<LL', m, offset)
+        compid ^= key
+        entries.append({'product' : compid >> 16, 'build' : compid & 0xffff, 'count' : count ^ key})
+
+    return {'key' : '%08x' % key, 'entries' : entries}
+
+
+def _imports(m, rva, sections, headers, thunkSize):
+    """
+    (dll, function) pairs from the import directory, in table order
+    Ordinal imports are recorded as ordNNN
+    """
+    imports = []
+    offset  = _rvaToOffset(rva, sections, headers)
+    flag    = 1 << (thunkSize * 8 - 1)
+    fmt     = '<Q' if thunkSize == 8 else '<L'
+
+    for i in xrange(MAX_IMPORTS):
+        if offset is None or not _fits(m, offset + i * 20, 20):
+            break
+
+        lookup, stamp, chain, name, first = unpack_from('<LLLLL', m, offset + i * 20)
+        if not name:
+            break
+
+        dll = _cstring(m, _rvaToOffset(name, sections, headers) or -1)
+        if dll is None:
+            break
+
+        # Bound imports leave only the FirstThunk table intact
+        thunks = _rvaToOffset(lookup or first, sections, headers)
+
+        for j in xrange(MAX_THUNKS):
+            if thunks is None or not _fits(m, thunks + j * thunkSize, thunkSize):
+                break
+
+            thunk = unpack_from(fmt, m, thunks + j * thunkSize)[0]
+            if not thunk:
+                break
+
+            if thunk & flag:
+                imports.append((dll, 'ord%d' % (thunk & 0xffff)))
+            else:
+                function = _cstring(m, (_rvaToOffset(thunk & 0x7fffffff, sections, headers) or -3) + 2)
+                if function is None:
+                    break
+                imports.append((dll, function))
+
+    return imports
+
+
+def imphash(imports):
+    """
+    MD5 of the lower-cased 'dll.function' list, as popularized by Mandiant
+    (ordinals are never resolved to names here, so ws2_32/oleaut32 ordinal imports can differ from pefile)
+    """
+    if not imports:
+        return
+
+    names = []
+    for dll, function in imports:
+        dll = dll.lower()
+        base, _, ext = dll.rpartition('.')
+        if ext in ('dll', 'ocx', 'sys'):
+            dll = base
+        names.append('%s.%s' % (dll, function.lower()))
+
+    return hashlib.md5(','.join(names)).hexdigest()
+
+
+def _debug(m, rva, size, sections, headers):
+    """
+    Debug directory entries, with the PDB path of CodeView (RSDS) records
+    """
+    entries = []
+    offset  = _rvaToOffset(rva, sections, headers)
+
+    for i in xrange(min(size // 28, MAX_DEBUG)):
+        if offset is None or not _fits(m, offset + i * 28, 28):
+            break
+
+        flags, stamp, major, minor, kind, length, address, pointer = unpack_from('<LLHHLLLL', m, offset + i * 28)
+        entry = {'type' : DEBUG_TYPES.get(kind, kind), 'timestamp' : stamp}
+
+        if kind == 2 and length > 24 and _fits(m, pointer, 24) and m[pointer:pointer + 4] == 'RSDS':
+            entry['pdb'] = _cstring(m, pointer + 24, min(length - 24, MAX_NAME))
+
+        entries.append(entry)
+
+    return entries
+
+
+def parsePE(filePath, cache = None):
+    """
+    Header metadata of a PE as a dict, or None if it isn't one (or can't be read)
+    The file is mapped rather than read, so large binaries cost no more than small ones;
+    every offset taken from the file is bounds checked before it's followed
+    """
+
+    # Keyed on content (the digest itself is remembered against size and mtime)
+    if cache is not None:
+        try:
+            return cache.cached(filePath, 'pe-header', CACHE_VERSION, lambda: parsePE(filePath))
+        except (IOError, OSError):
             return
 
-        #   ValueError: invalid literal for int() with base 16: ''
-        #   https://stackoverflow.com/questions/11826054/valueerror-invalid-literal-for-int-with-base-16-x0e-xa3-python
-        #   https://stackoverflow.com/questions/20375706/valueerror-invalid-literal-for-int-with-base-10-python
-        #       This indicates that for some reason, 'offset' from above is being set as '' and thus can't be converted to a base 16 int
-        offset = int(offset, 16)
+    try:
+        handle = open(filePath, 'rb')
+    except (IOError, OSError):
+        return
+
+    try:
+        try:
+            m = mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ)
+        except (ValueError, mmap.error, OverflowError):
+            return
 
-        # Seek to PE header and read second DWORD
-        handle.seek(offset+8, 0)
-        dword = handle.read(4)
+        try:
+            return _parseMapped(m)
+        finally:
+            m.close()
+    finally:
         handle.close()
 
-        # Attempt to unpack
-        #   This try was added in because some files pass the above check, but still cause the unpack to puke
-        #   eg: struct.error: unpack requires a string argument of length 4
 
-        t = unpack(">L", dword[::-1])[0]
-    except:
+def _parseMapped(m):
+
+    if not _fits(m, LFANEW, 4) or m[:2] != 'MZ':
+        return
+
+    lfanew = unpack_from('<L', m, LFANEW)[0]
+    if not _fits(m, lfanew, 24) or m[lfanew:lfanew + 4] != 'PE\x00\x00':
+        return
+
+    machine, count, stamp, symbols, nsymbols, optionalSize, characteristics = unpack_from('<HHLLLHH', m, lfanew + 4)
+
+    info = {
+        'machine'           :   MACHINES.get(machine, '0x%04x' % machine),
+        'timestamp'         :   stamp,
+        'utc'               :   formatTimestamp(stamp),
+        'characteristics'   :   characteristics,
+        'rich'              :   _rich(m, lfanew),
+        'sections'          :   [],
+    }
+
+    optional = lfanew + 24
+    table    = optional + optionalSize
+
+    for i in xrange(min(count, MAX_SECTIONS)):
+        if not _fits(m, table + i * 40, 40):
+            break
+
+        name, vsize, va, rawSize, rawOffset = unpack_from('<8sLLLL', m, table + i * 40)
+        flags = unpack_from('<L', m, table + i * 40 + 36)[0]
+
+        info['sections'].append({
+            'name'              :   name.rstrip('\x00'),
+            'virtual_address'   :   va,
+            'virtual_size'      :   vsize,
+            'raw_offset'        :   rawOffset,
+            'raw_size'          :   rawSize,
+            'characteristics'   :   flags,
+        })
+
+    if optionalSize < 2 or not _fits(m, optional, 2):
+        return info
+
+    magic = unpack_from('<H', m, optional)[0]
+    if magic not in OPTIONAL:
+        return info
+
+    kind, thunkSize, directories = OPTIONAL[magic]
+    info['format'] = kind
+
+    # Subsystem and SizeOfHeaders sit at the same offsets in PE32 and PE32+
+    if optionalSize >= 70 and _fits(m, optional, 70):
+        info['entry_point'] = unpack_from('<L', m, optional + 16)[0]
+        info['size_of_image'], headers, info['checksum'], info['subsystem'] = unpack_from('<LLLH', m, optional + 56)
+    else:
+        headers = 0
+
+    # Directory 1 is imports, 6 is debug
+    def directory(index):
+        offset = optional + directories + index * 8
+        if offset + 8 > optional + optionalSize or not _fits(m, offset, 8):
+            return 0, 0
+        return unpack_from('<LL', m, offset)
+
+    sections = info['sections']
+
+    rva, size = directory(1)
+    if rva:
+        imports = _imports(m, rva, sections, headers, thunkSize)
+        info['imports'] = len(imports)
+        info['imphash'] = imphash(imports)
+
+    rva, size = directory(6)
+    if rva:
+        info['debug'] = _debug(m, rva, size, sections, headers)
+
+    return info
+
+
+def formatTimestamp(t):
+    return strftime('%Y-%m-%d %H:%M:%S', gmtime(float(t)))
+
+
+def getEpoch(filePath, epoch = True):
+
+    # Open the file in Binary mode
+    try:
+        with open(filePath, 'rb') as handle:
+            t = readTimestamp(handle)
+    except (IOError, OSError):
+        return
+
+    if t is None:
         return
 
     if epoch:
         return t
     else:
-        return strftime('%Y-%m-%d %H:%M:%S', gmtime(float(t)))
+        return formatTimestamp(t)
 
 
 
 def getUTC(filePath):
-    return getEpoch(filepath, False)
+    return getEpoch(filePath, False)
 
 def getBoth(filePath):
-    return [getEpoch(filepath), getEpoch(filepath, False)]
+    t = getEpoch(filePath)
+    if t is None:
+        return [None, None]
+    return [t, formatTimestamp(t)]
+
+
+def _isRegular(path):
+    try:
+        return stat.S_ISREG(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def _regularFiles(directory):
+    """
+    Regular files (or links to them) under directory. FIFOs, sockets and devices are
+    left out: opening a FIFO blocks until something writes to it
+    """
+
+    if scandir is None:
+        for root, dirs, files in walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if _isRegular(path):
+                    yield path
+        return
+
+    pending = [directory]
+    while pending:
+        try:
+            entries = scandir(pending.pop())
+        except OSError:
+            continue
+
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks = False):
+                    pending.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path
+            except OSError:
+                continue
+
+
+def walkFiles(paths):
+    """
+    Every regular file under paths, lazily. Named files are passed through unless
+    they exist and aren't regular (a missing one just scans as None)
+    """
+
+    for path in paths:
+        if os.path.isdir(path):
+            for name in _regularFiles(path):
+                yield name
+
+        elif _isRegular(path) or not os.path.exists(path):
+            yield path
+
+
+def scanPaths(paths, workers = 16, full = False, cache = None):
+    """
+    Yield (path, epoch or None) for every file under paths, in completion order
+    With full, yield (path, parsePE() dict or None) instead
+    Threads overlap the I/O; the parse itself is a couple of unpack_from calls
+    With full, cache may be a ResultCache or a path; one opened from a path is closed when we're done
+    """
+
+    # One connection, shared by the pool's threads
+    opened = full and isinstance(cache, basestring)
+    if opened:
+        cache = ResultCache(cache)
+
+    if full:
+        parse = lambda path: (path, parsePE(path, cache = cache))
+    else:
+        parse = lambda path: (path, getEpoch(path))
+
+    pool  = ThreadPool(workers)
+    files = walkFiles(paths)
+
+    try:
+        while True:
+            chunk = list(islice(files, SCAN_BATCH))
+            if not chunk:
+                break
+
+            for result in pool.imap_unordered(parse, chunk, 64):
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        if opened:
+            cache.close()
+
+
+def writeCSV(results, handle):
+    """
+    path, epoch, utc rows with a header. Non-PE files get empty timestamps
+    """
+
+    writer = csv.writer(handle)
+    writer.writerow(['path', 'epoch', 'utc'])
+
+    count = 0
+    for path, t in results:
+        writer.writerow([path, '' if t is None else t, '' if t is None else formatTimestamp(t)])
+        count += 1
+    return count
+
+
+def writeNDJSON(results, handle):
+    """
+    One {"path", "epoch", "utc"} object per line. Non-PE files get nulls
+    parsePE() dicts (scanPaths(full = True)) are written out whole, with the path added
+    """
+
+    count = 0
+    for path, t in results:
+        if isinstance(t, dict):
+            record = dict(t, path = path)
+        else:
+            record = {'path' : path, 'epoch' : t, 'utc' : None if t is None else formatTimestamp(t)}
+        handle.write(json.dumps(record) + "\n")
+        count += 1
+    return count
+
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Read the compile timestamp of every PE under the given paths")
+    parser.add_argument('path', nargs = '+', help = "Files and directories to scan")
+    parser.add_argument('--format', choices = ['csv', 'ndjson'], default = 'csv', help = "Output format")
+    parser.add_argument('--output', help = "Write to this file instead of stdout")
+    parser.add_argument('--workers', type = int, default = 16, help = "Reader threads")
+    parser.add_argument('--pe-only', action = 'store_true', help = "Leave out files that aren't PEs")
+    parser.add_argument('--cache', help = "With --full, keep results in this SQLite database and skip files already parsed (see resultcache.py)")
+    parser.add_argument('--full', action = 'store_true', help = "Emit machine, sections, imphash, debug directory and Rich header too (NDJSON only)")
+    args = parser.parse_args()
+
+    if args.full and args.format != 'ndjson':
+        parser.error("--full needs --format ndjson")
+
+    if args.cache and not args.full:
+        parser.error("--cache needs --full (timestamps are cheaper to read than to look up)")
+
+    cache   = ResultCache(args.cache) if args.cache else None
+
+    results = scanPaths(args.path, args.workers, args.full, cache)
+    if args.pe_only:
+        results = ((path, t) for path, t in results if t is not None)
+
+    output = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        (writeNDJSON if args.format == 'ndjson' else writeCSV)(results, output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if cache is not None:
+            cache.close()
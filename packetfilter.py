@@ -0,0 +1,279 @@
+#! /usr/bin/env python2.7
+#
+#   packetfilter.py
+#
+#   A small BPF-like filter language for packetsummary. Expressions are compiled
+#   once into nested Python closures that test the raw header fields packetsummary
+#   pulls out of each frame (packetsummary.ip_fields), before any dpkt objects
+#   are built. Frames that don't match cost a few byte comparisons.
+#
+#   Grammar (as in tcpdump, 'and' and 'or' share a precedence and group left to right):
+#
+#       expr        :=  term (('and' | '&&' | 'or' | '||') term)*
+#       term        :=  ('not' | '!') term | '(' expr ')' | primitive
+#       primitive   :=  [proto] [src | dst] (host ADDR | net CIDR | port PORT | portrange LO-HI)
+#                   |   proto
+#                   |   'proto' NUMBER
+#       proto       :=  ip | ip6 | tcp | udp | icmp | icmp6
+#
+#   A bare value after 'and' / 'or' reuses the previous qualifiers, so
+#   'tcp port 80 or 443' means 'tcp port 80 or tcp port 443'. 'net private'
+#   matches RFC1918 and IPv6 unique local addresses.
+#
+#   eg: udp port 53 or (tcp dst port 80 or 443 and not dst net private)
+
+# Standard Lib
+import re
+import socket
+import struct
+
+
+# Fields are (IP version, IP protocol, src address, dst address, src port, dst port)
+VERSION, PROTO, SRC, DST, SPORT, DPORT = range(6)
+
+PROTOCOLS       =   {
+    'tcp'       :   6,
+    'udp'       :   17,
+    'icmp'      :   1,
+    'icmp6'     :   58,
+}
+
+PRIVATE_NETS    =   ['10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', 'fc00::/7']
+
+TOKEN_RE        =   re.compile(r'\s*(\(|\)|&&|\|\||!|[^\s()!&|]+)')
+
+
+def _address(value):
+    """
+    Packed form of an IPv4 or IPv6 address
+    """
+    family = socket.AF_INET6 if ':' in value else socket.AF_INET
+
+    try:
+        return socket.inet_pton(family, value)
+    except (socket.error, ValueError):
+        raise Exception("Bad address in filter: {0}".format(value))
+
+
+def _as_int(packed):
+    """
+    Turn a packed 4 or 16 byte address into an integer
+    """
+    if len(packed) == 4:
+        return struct.unpack('>I', packed)[0]
+
+    high, low = struct.unpack('>QQ', packed)
+    return (high << 64) | low
+
+
+def _network(value):
+    """
+    (address length, network, mask) for a CIDR, or a bare address as a /32 or /128
+    """
+    address, _, bits = value.partition('/')
+    packed = _address(address)
+    width = len(packed) * 8
+
+    try:
+        bits = int(bits) if bits else width
+    except ValueError:
+        raise Exception("Bad prefix length in filter: {0}".format(value))
+
+    if not 0 <= bits <= width:
+        raise Exception("Bad prefix length in filter: {0}".format(value))
+
+    mask = ((1 << bits) - 1) << (width - bits)
+    return len(packed), _as_int(packed) & mask, mask
+
+
+def _port(value):
+    """
+    A port number or service name
+    """
+    if value.isdigit():
+        port = int(value)
+    else:
+        try:
+            port = socket.getservbyname(value)
+        except socket.error:
+            raise Exception("Unknown port in filter: {0}".format(value))
+
+    if not 0 <= port <= 0xffff:
+        raise Exception("Bad port in filter: {0}".format(value))
+    return port
+
+
+def _directed(test, direction, src, dst):
+    """
+    Apply a single value test to the source, destination or either field
+    """
+    if direction == 'src':
+        return lambda f: test(f[src])
+    if direction == 'dst':
+        return lambda f: test(f[dst])
+    return lambda f: test(f[src]) or test(f[dst])
+
+
+def _primitive(proto, direction, kind, value):
+    """
+    Build the closure for a single primitive
+    """
+
+    if kind == 'host':
+        packed = _address(value)
+        test = _directed(lambda a: a == packed, direction, SRC, DST)
+
+    elif kind == 'net':
+        nets = [_network(n) for n in (PRIVATE_NETS if value == 'private' else [value])]
+
+        def inside(a):
+            if a is None:
+                return False
+            for length, network, mask in nets:
+                if len(a) == length and _as_int(a) & mask == network:
+                    return True
+            return False
+
+        test = _directed(inside, direction, SRC, DST)
+
+    elif kind == 'port':
+        port = _port(value)
+        test = _directed(lambda p: p == port, direction, SPORT, DPORT)
+
+    elif kind == 'portrange':
+        low, _, high = value.partition('-')
+        low, high = _port(low), _port(high)
+        test = _directed(lambda p: p is not None and low <= p <= high, direction, SPORT, DPORT)
+
+    elif kind == 'proto':
+        number = PROTOCOLS.get(value)
+        if number is None:
+            if not value.isdigit():
+                raise Exception("Unknown protocol in filter: {0}".format(value))
+            number = int(value)
+        test = lambda f: f[PROTO] == number
+
+    else:
+        test = None
+
+    # A protocol qualifier narrows whatever else we were asked for
+    if proto is None:
+        return test
+
+    if proto == 'ip':
+        check = lambda f: f[VERSION] == 4
+    elif proto == 'ip6':
+        check = lambda f: f[VERSION] == 6
+    else:
+        number = PROTOCOLS[proto]
+        check = lambda f: f[PROTO] == number
+
+    if test is None:
+        return check
+    return lambda f: check(f) and test(f)
+
+
+class _Parser(object):
+    """
+    Recursive descent over the token list, producing closures
+    """
+
+    def __init__(self, expression):
+        self.tokens     =   TOKEN_RE.findall(expression)
+        self.position   =   0
+
+        # Qualifiers of the last primitive, for 'port 80 or 443'
+        self.last       =   None
+
+        if ''.join(self.tokens) != re.sub(r'\s', '', expression):
+            raise Exception("Can't parse filter: {0}".format(expression))
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take(self):
+        token = self.peek()
+        if token is None:
+            raise Exception("Filter ended unexpectedly")
+        self.position += 1
+        return token
+
+    def parse(self):
+        test = self.expression()
+        if self.peek() is not None:
+            raise Exception("Unexpected '{0}' in filter".format(self.peek()))
+        return test
+
+    def expression(self):
+        test = self.term()
+
+        while self.peek() in ('and', '&&', 'or', '||'):
+            op      =   self.take()
+            left    =   test
+            right   =   self.term()
+
+            if op in ('and', '&&'):
+                test = (lambda l, r: lambda f: l(f) and r(f))(left, right)
+            else:
+                test = (lambda l, r: lambda f: l(f) or r(f))(left, right)
+
+        return test
+
+    def term(self):
+        token = self.peek()
+
+        if token in ('not', '!'):
+            self.take()
+            inner = self.term()
+            return lambda f: not inner(f)
+
+        if token == '(':
+            self.take()
+            inner = self.expression()
+            if self.take() != ')':
+                raise Exception("Missing ')' in filter")
+            return inner
+
+        return self.primitive()
+
+    def primitive(self):
+        proto, direction, kind = None, None, None
+
+        if self.peek() in PROTOCOLS or self.peek() in ('ip', 'ip6'):
+            proto = self.take()
+
+        if self.peek() in ('src', 'dst'):
+            direction = self.take()
+
+        if self.peek() in ('host', 'net', 'port', 'portrange', 'proto'):
+            kind = self.take()
+
+        # Just a protocol
+        if kind is None and direction is None and proto is not None:
+            return _primitive(proto, None, None, None)
+
+        if self.peek() is None:
+            raise Exception("Filter ended unexpectedly")
+
+        # A bare value inherits the previous primitive's qualifiers
+        if kind is None:
+            if self.last is None or direction is not None or proto is not None:
+                raise Exception("Filter value '{0}' needs host, net, port or portrange".format(self.peek()))
+            proto, direction, kind = self.last
+
+        self.last = (proto, direction, kind)
+        return _primitive(proto, direction, kind, self.take())
+
+
+def compile_filter(expression = None):
+    """
+    Compile a filter expression into a function of the ip_fields tuple
+    Raises an exception on malformed expressions
+    """
+
+    if not expression or not expression.strip():
+        raise Exception("Empty filter expression")
+
+    return _Parser(expression).parse()
@@ -11,511 +11,3027 @@
 
 # Requirements
 import dpkt
-import magic
+
+# Optional: libmagic is only used to describe files we refuse (see describe_file)
+
+# Local
+from signatures import SignatureSet
+from packetfilter import compile_filter
+from columnar import ColumnarWriter, flatten
+from resultcache import ResultCache
 
 # Standard Lib
 import socket
 import string
 import os
+import mmap
 import urlparse
 import re
-
-class packetsummary(object):
+import struct
+import zlib
+import hashlib
+import timeit
+import json
+import multiprocessing
+import cPickle as pickle
+from collections import namedtuple, OrderedDict, deque
+
+
+# Payload signatures. Compiled once per process rather than once per capture
+STRATUM_RE              =   re.compile('^\{"method": "mining.authorize".*\["(.*)", "(.*)"\]')
+SSH_CLIENT_RE           =   re.compile('^SSH.*-OpenSSH_\d.*\s.*\-.*\x0D\x0A$')
+SSH_SERVER_RE           =   re.compile('^SSH.*-OpenSSH_\d.*\x0D\x0A$')
+
+# What sniff_capture() learns from a capture's file header
+CaptureHeader = namedtuple('CaptureHeader', ['format', 'endian', 'nanosecond', 'version', 'snaplen', 'linktype'])
+
+# First-bytes classification of TCP payloads
+#   HTTP methods are dpkt's own list, so we accept exactly what dpkt.http.Request does
+HTTP_METHODS            =   frozenset(dpkt.http.Request._Request__methods)
+TLS_CONTENT_TYPES       =   frozenset('\x14\x15\x16\x17\x18')
+
+# Payload packets we'll look at before giving up on classifying a flow
+CLASSIFY_PROBES         =   4
+
+# Stream reassembly
+#   Protocols whose dissectors run on reassembled streams rather than segments
+STREAM_PROTOCOLS        =   frozenset(['http', 'smtp', 'irc', 'ssl'])
+#   Bytes of unconsumed data held per direction before we force it through the dissector
+STREAM_LIMIT            =   256 * 1024
+#   Out-of-order segments parked per direction before we write the gap off
+STREAM_PENDING          =   64
+#   Seconds of capture time after which a quiet stream is flushed
+STREAM_IDLE             =   300
+
+# TLS handshakes
+TLS_VERSIONS            =   {0x0300 : 'SSLv3', 0x0301 : 'TLSv1.0', 0x0302 : 'TLSv1.1', 0x0303 : 'TLSv1.2', 0x0304 : 'TLSv1.3'}
+#   RFC 8701 reserved values, left out of JA3 / JA3S
+TLS_GREASE              =   frozenset(0x0a0a + 0x1010 * i for i in range(16))
+#   X.509 name attributes we render, by DER encoded OID
+X509_ATTRIBUTES         =   {
+    '\x55\x04\x03'   :   'CN',
+    '\x55\x04\x06'   :   'C',
+    '\x55\x04\x07'   :   'L',
+    '\x55\x04\x08'   :   'ST',
+    '\x55\x04\x0a'   :   'O',
+    '\x55\x04\x0b'   :   'OU',
+}
+
+IRC_PORTS               =   frozenset(range(6660, 6670) + [7000])
+IRC_COMMANDS            =   frozenset(['PASS', 'NICK', 'USER', 'JOIN', 'PRIVMSG', 'NOTICE', 'TOPIC'])
+CONTENT_LENGTH_RE       =   re.compile('\r\ncontent-length:[ \t]*(\d+)', re.I)
+
+# DNS record types we report, and how to turn each answer's rdata into a string
+DNS_TYPES               =   {
+    dpkt.dns.DNS_A          :   'A',
+    dpkt.dns.DNS_AAAA       :   'AAAA',
+    dpkt.dns.DNS_MX         :   'MX',
+    dpkt.dns.DNS_NS         :   'NS',
+    dpkt.dns.DNS_TXT        :   'TXT',
+    dpkt.dns.DNS_CNAME      :   'CNAME',
+    dpkt.dns.DNS_PTR        :   'PTR',
+    dpkt.dns.DNS_SOA        :   'SOA',
+    dpkt.dns.DNS_SRV        :   'SRV',
+    dpkt.dns.DNS_HINFO      :   'HINFO',
+}
+
+DNS_ANSWER_DECODERS     =   {
+    dpkt.dns.DNS_A          :   lambda ans: socket.inet_ntoa(ans.rdata),
+    dpkt.dns.DNS_AAAA       :   lambda ans: socket.inet_ntop(socket.AF_INET6, ans.rdata),
+    dpkt.dns.DNS_SOA        :   lambda ans: ','.join([ ans.mname, ans.rname, str(ans.serial), str(ans.minimum), str(ans.refresh), str(ans.retry), str(ans.expire) ]),
+    dpkt.dns.DNS_MX         :   lambda ans: ans.mxname,
+    dpkt.dns.DNS_NS         :   lambda ans: ans.nsname,
+    dpkt.dns.DNS_TXT        :   lambda ans: ' '.join(ans.text),
+    dpkt.dns.DNS_CNAME      :   lambda ans: ans.cname,
+    dpkt.dns.DNS_PTR        :   lambda ans: ans.ptrname,
+    dpkt.dns.DNS_HINFO      :   lambda ans: ' '.join(ans.text),
+    dpkt.dns.DNS_SRV        :   lambda ans: ' '.join([ str(ans.priority), str(ans.weight), str(ans.port), ans.srvname ]),
+}
+
+# Decoded DNS messages kept per capture
+DNS_CACHE_SIZE          =   4096
+DNS_UNCACHED            =   object()
+
+# UDP payloads on these ports are always offered to the DNS decoder (DNS, mDNS);
+# anything else has to look like a DNS header first (see dns_plausible)
+DNS_PORTS               =   frozenset([53, 5353])
+
+# Instrumentation (packetsummary(stats = True)): transport names to count packets
+# under, and the dissectors whose calls and cumulative time we record
+IP_PROTOCOL_NAMES       =   {
+    dpkt.ip.IP_PROTO_TCP    :   'tcp',
+    dpkt.ip.IP_PROTO_UDP    :   'udp',
+    dpkt.ip.IP_PROTO_ICMP   :   'icmp',
+    dpkt.ip.IP_PROTO_ICMP6  :   'icmp6',
+}
+DISSECTORS              =   ['_parse_tcp', '_parse_udp', '_parse_icmp', '_tcp_reassemble', '_tcp_parse_http', '_tcp_stream_http',
+                             '_tcp_stream_smtp', '_tcp_stream_irc', '_tcp_stream_ssl', '_tls_handshake', '_udp_parse_dns',
+                             '_match_signatures']
+
+# IPv6 extension headers we step over to reach the upper layer: hop-by-hop,
+# routing, fragment, authentication and destination options
+IP6_EXTENSIONS          =   frozenset([0, 43, 44, 51, 60])
+
+# ICMP is read straight off the frame. Next header bytes that may lead to ICMPv6
+ICMP_PROTOCOLS          =   frozenset([dpkt.ip.IP_PROTO_ICMP, dpkt.ip.IP_PROTO_ICMP6])
+ICMP6_NEXT              =   frozenset(chr(p) for p in IP6_EXTENSIONS | set([dpkt.ip.IP_PROTO_ICMP6]))
+
+# (echo request, echo reply, destination unreachable) type per IP version
+ICMP_TYPES              =   {4 : (8, 0, 3), 6 : (128, 129, 1)}
+
+ICMP_UNREACHABLE        =   {
+    4   :   {0 : 'net', 1 : 'host', 2 : 'protocol', 3 : 'port', 4 : 'fragmentation needed', 5 : 'source route failed',
+             6 : 'net unknown', 7 : 'host unknown', 9 : 'net prohibited', 10 : 'host prohibited', 13 : 'prohibited'},
+    6   :   {0 : 'no route', 1 : 'prohibited', 2 : 'beyond scope', 3 : 'address', 4 : 'port', 5 : 'policy', 6 : 'reject route'},
+}
+
+# Echo sessions that look like a tunnel rather than ping: payloads bigger than any
+# stock ping sends, more distinct sizes than one ping run uses, or replies that
+# don't echo the request's size. Unanswered requests kept per session for pairing
+ICMP_TUNNEL_SIZE        =   128
+ICMP_SIZE_VARIETY       =   4
+ICMP_PENDING            =   64
+
+# Checkpoints: bump the version whenever the saved state changes shape. The leading
+# bytes of the capture are hashed so a rotated file isn't mistaken for the old one
+CHECKPOINT_VERSION      =   3
+CHECKPOINT_SAMPLE       =   4096
+
+# Bump whenever run()'s output changes, so cached summaries from older code aren't served
+CACHE_VERSION           =   1
+
+# Byte -> its printable form, either itself or a \xNN escape
+PRINTABLE_ESCAPES       =   [chr(i) if chr(i) in string.printable else "\\x%02x" % i for i in range(256)]
+NONPRINTABLE_RE         =   re.compile('[^' + re.escape(string.printable) + ']')
+
+# Only this many bytes of a payload are escaped; the rest is summarized
+PRINTABLE_LIMIT         =   8192
+
+# A single unit of output from packetsummary.iter_events()
+#   type        One of EVENT_TYPES
+#   timestamp   Capture timestamp of the packet that produced the event
+#   data        The record run() would have stored under results[EVENT_TYPES[type]]
+PacketEvent = namedtuple('PacketEvent', ['type', 'timestamp', 'data'])
+
+# Event type -> results key
+EVENT_TYPES             =   {
+    'host'              :   'hosts',
+    'dns'               :   'dns',
+    'http'              :   'http',
+    'ssl'               :   'ssl',
+    'ssh'               :   'ssh',
+    'stratum'           :   'stratum',
+    'smtp'              :   'smtp',
+    'irc'               :   'irc',
+    'signature'         :   'signatures',
+    'tcp'               :   'tcp_connections',
+    'udp'               :   'udp_connections',
+    'icmp'              :   'icmp_requests',
+    'icmp_unreachable'  :   'icmp_unreachable',
+}
+
+# Events whose data is a list get these column names in write_columnar()
+COLUMNAR_FIELDS         =   {
+    'ssl'               :   ('timestamp', 'note', 'details'),
+    'ssh'               :   ('timestamp', 'note'),
+    'irc'               :   ('timestamp', 'details'),
+    'stratum'           :   ('timestamp', 'details'),
+    'signature'         :   ('timestamp', 'details'),
+}
+
+
+class PcapReader(object):
     """
-    Accepts a filepath as a single argument, returns a dict
-    Raises an exceptions on errors
+    mmap backed pcap / pcapng reader. Record headers are decoded in place and each
+    frame is handed out as a read-only buffer() over the mapping instead of a copy
+
+    Frames are only valid until close() is called; anything that needs to outlive
+    the reader has to slice (copy) them first
+
+    Records outside [start, end] are stepped over by their headers alone, and
+    iteration stops at the first record past end. position (and, for pcapng,
+    context) say where iteration stopped, and resume() picks up from there
     """
 
-    def __init__(self, path = None):
-        """
-        Initialize
-        """
+    # Magic -> (struct byte order, timestamp fraction divisor)
+    MAGICS              =   {
+        '\xd4\xc3\xb2\xa1'  :   ('<', 1000000.0),
+        '\xa1\xb2\xc3\xd4'  :   ('>', 1000000.0),
+        '\x4d\x3c\xb2\xa1'  :   ('<', 1000000000.0),
+        '\xa1\xb2\x3c\x4d'  :   ('>', 1000000000.0),
+    }
 
-        if path == None:
-            raise Exception("No filepath to our pcap specified")
+    # pcapng Section Header Block, and its byte-order magic -> struct byte order
+    PCAPNG_MAGIC        =   '\x0a\x0d\x0d\x0a'
+    PCAPNG_BYTE_ORDERS  =   {
+        '\x4d\x3c\x2b\x1a'  :   '<',
+        '\x1a\x2b\x3c\x4d'  :   '>',
+    }
 
-        if not os.path.exists(path):
-            raise Exception("Filepath {0} doesn't exist".format(path))
+    def __init__(self, path = None, start = None, end = None):
 
-        if os.path.getsize(path) == 0:
-            raise Exception("The file supplied is zero bytes in size...")
+        self.start          =   float('-inf') if start is None else start
+        self.end            =   float('inf') if end is None else end
 
-        mime    =   magic.from_file(path, mime=True)
-        if mime != "application/vnd.tcpdump.pcap":
-            raise Exception("Bad mime type for this file ({0}). Must be application/vnd.tcpdump.pcap".format(mime))
+        try:
+            self.handle     =   open(path, 'rb')
+            self.map        =   mmap.mmap(self.handle.fileno(), 0, access = mmap.ACCESS_READ)
+        except(IOError, OSError, ValueError, mmap.error):
+            raise Exception("Unable to open our file, and/or read from it")
 
-        # Set our instance vars
-        self.path               =   path
-        self.smtpFlows          =   {}
+        head = self.map[:4]
 
-        self.stratumRE          =   re.compile('^\{"method": "mining.authorize".*\["(.*)", "(.*)"\]')
-        self.SSHRE1             =   re.compile('^SSH.*-OpenSSH_\d.*\s.*\-.*\x0D\x0A$')
-        self.SSHRE2             =   re.compile('^SSH.*-OpenSSH_\d.*\x0D\x0A$')
+        if len(self.map) >= 24 and head in self.MAGICS:
+            self.format                 =   'pcap'
+            self.endian, self.divisor   =   self.MAGICS[head]
+            self.snaplen, self.linktype =   struct.unpack_from(self.endian + 'II', self.map, 16)
+            self.recordHeader           =   struct.Struct(self.endian + 'IIII')
+            self.position               =   24
+            self.context                =   None
 
+        elif len(self.map) >= 28 and head == self.PCAPNG_MAGIC and self.map[8:12] in self.PCAPNG_BYTE_ORDERS:
+            self.format                 =   'pcapng'
+            self.endian                 =   self.PCAPNG_BYTE_ORDERS[self.map[8:12]]
 
-        # Define our result skeleton
-        self.results            =   {
+            # Per interface, and may change from section to section
+            self.snaplen                =   None
+            self.linktype               =   None
 
-            # Hosts
-            'hosts'             :   [],
+            # Byte order, interfaces and last timestamp of the section we're in
+            self.position               =   0
+            self.context                =   None
 
-            # Domain
-            'domains'           :   [],
-            'dns'               :   [],
+        else:
+            self.close()
+            raise Exception("{0} is not a pcap or pcapng file".format(path))
 
-            # HTTP
-            'http'              :   [],
+    def resume(self, position = None, context = None):
+        """
+        Continue from a position (and pcapng context) saved by an earlier reader
+        """
 
-            # Flows
-            'tcp_connections'   :   [],
-            'udp_connections'   :   [],
-            'icmp_requests'     :   [],
+        if position > len(self.map):
+            raise Exception("Can't resume past the end of the capture")
 
-            # Application traffic
-            'smtp'              :   [],
-            'irc'               :   [],
-            'stratum'           :   [],
-            'ssl'               :   [],
-            'ssh'               :   [],
-        }
+        self.position   =   position
+        self.context    =   context
 
-    def _convert_string_to_printable(self, s = None):
+    def __iter__(self):
         """
-        Ensure that the passed string contains only printable characters.
-        If it doesn't, convert those that aren't to hex
+        Yield (timestamp, frame, link type) for every complete record
         """
-        r = ""
-        for c in s:
-            if c not in string.printable:
-                r += "\\x%02x" % ord(c)
-            else:
-                r += c
-        return r
 
-    def _tcp_parse_http(self, c = None, data = None):
+        if self.format == 'pcapng':
+            return self._iter_pcapng()
+        return self._iter_pcap()
+
+    def _iter_pcap(self):
+
+        m           =   self.map
+        size        =   len(m)
+        offset      =   self.position
+        unpack      =   self.recordHeader.unpack_from
+        divisor     =   self.divisor
+        linktype    =   self.linktype
+        start       =   self.start
+        end         =   self.end
+
+        try:
+            while offset + 16 <= size:
+                sec, frac, caplen, wirelen = unpack(m, offset)
+
+                # Truncated final record (or one still being written)
+                if offset + 16 + caplen > size:
+                    break
+
+                timestamp = sec + frac / divisor
+                if timestamp > end:
+                    break
+
+                record  =   offset + 16
+                offset  =   record + caplen
+
+                if timestamp >= start:
+                    yield timestamp, buffer(m, record, caplen), linktype
+
+        finally:
+            self.position = offset
+
+    def _iter_pcapng(self):
         """
-        Extract HTTP Flow information and add it to our results
-        We've opted to re-parse the data portion of our packet as our check sets valid defaults to False
+        Walk pcapng blocks. Interfaces (and so link types and timestamp units)
+        are tracked per section, so multi-interface captures come out in one pass
         """
 
-        try:
-            http            =   dpkt.http.Request()
-            http.unpack(data)
-        except:
-            pass
+        m           =   self.map
+        size        =   len(m)
+        offset      =   self.position
+        start       =   self.start
+        stop        =   self.end
+
+        if self.context is None:
+            endian, interfaces, timestamp = self.endian, [], 0.0
+        else:
+            endian, interfaces, timestamp = self.context
+            interfaces = list(interfaces)
 
         try:
+            while offset + 12 <= size:
 
-            flow            =   {
-                'host'          :   None,
-                'port'          :   c['spt'],
-                'payload'       :   self._convert_string_to_printable(data),
+                # A new section may switch byte order, and always starts a new set of interfaces
+                if m[offset:offset + 4] == self.PCAPNG_MAGIC:
+                    endian      =   self.PCAPNG_BYTE_ORDERS.get(m[offset + 8:offset + 12])
+                    interfaces  =   []
+                    if endian is None:
+                        break
 
-                # https://docs.python.org/2/library/urlparse.html#urlparse.urlunparse
-                'uri'           :   None,
-                'body'          :   self._convert_string_to_printable(http.body),
-                'path'          :   self._convert_string_to_printable(http.uri),
-                'user-agent'    :   self._convert_string_to_printable(http.headers['user-agent']) if 'user-agent' in http.headers else None,
-                'version'       :   self._convert_string_to_printable(http.version),
-                'method'        :   self._convert_string_to_printable(http.method)
-            }
+                btype, blen = struct.unpack_from(endian + 'II', m, offset)
 
-            # Check for a host
-            if 'host' in http.headers:
-                flow['host'] = self._convert_string_to_printable(http.headers['host'])
+                if blen < 12 or offset + blen > size:
+                    break
 
-            # Build our URI
-            flow['uri']         =   self._convert_string_to_printable(urlparse.urlunparse(
-                    (
-                        'http',
-                        flow['host'],
-                        http.uri,
-                        None,
-                        None,
-                        None
-                    )
-                ))
+                body    =   offset + 8
+                end     =   offset + blen - 4
+                frame   =   None
 
-            # Add our flow to our results
-            self.results['http'].append(flow)
+                # Interface Description Block
+                if btype == 1:
+                    interfaces.append(self._pcapng_interface(endian, body, end))
 
-        except Exception:
-            pass
+                # Enhanced Packet Block
+                elif btype == 6:
+                    iface, high, low, caplen, wirelen = struct.unpack_from(endian + 'IIIII', m, body)
 
-    def _tcp_build_smtp(self, c = None, data = None, reassemble = False):
-        """
-        Build / Reassemble SMTP flows
-        """
+                    if iface < len(interfaces) and body + 20 + caplen <= end:
+                        linktype, units, tsoffset = interfaces[iface]
+                        stamp = ((high << 32) | low) / units + tsoffset
+                        frame = (body + 20, caplen)
 
-        if reassemble == False:
+                # Simple Packet Block: interface 0, no timestamp of its own
+                elif btype == 3:
+                    wirelen, = struct.unpack_from(endian + 'I', m, body)
 
-            if c['dst'] in self.smtpFlows:
-                self.smtpFlows[c['dst']] =+ data
-            else:
-                self.smtpFlows[c['dst']] = data
+                    if interfaces:
+                        linktype, stamp = interfaces[0][0], timestamp
+                        frame = (body + 4, min(wirelen, end - body - 4))
 
-        else:
+                # (Obsolete) Packet Block
+                elif btype == 2:
+                    iface, drops, high, low, caplen, wirelen = struct.unpack_from(endian + 'HHIIII', m, body)
 
-            for flow, data in self.smtpFlows.iteritems():
-                # New flow
-                if data.startswith("HELO") or data.startswith("HELO"):
-                    self.smtp_requests.appent({"dest":flow, "payload":data})
+                    if iface < len(interfaces) and body + 20 + caplen <= end:
+                        linktype, units, tsoffset = interfaces[iface]
+                        stamp = ((high << 32) | low) / units + tsoffset
+                        frame = (body + 20, caplen)
 
-    def _add_unique_domains(self, domain = None):
-        """
-        Attempt to add domain to our list of unique domains
-        """
-        if domain not in self.results['domains']:
-            self.results['domains'].append(domain)
+                if frame is not None:
+                    if stamp > stop:
+                        break
+
+                    timestamp = stamp
+
+                offset += blen
 
-    def _udp_parse_dns(self, data):
+                if frame is not None and timestamp >= start:
+                    yield timestamp, buffer(m, frame[0], frame[1]), linktype
+
+        finally:
+            self.position   =   offset
+            self.context    =   (endian, interfaces, timestamp)
+
+    def _pcapng_interface(self, endian, body, end):
         """
-        Parse all DNS stuffery and build our DNS result list
+        Decode an Interface Description Block into (link type, timestamp units per second, timestamp offset)
         """
 
-        dns                         =   dpkt.dns.DNS(data)
-        q                           =   {}
-        qType                       =   None
-        qName                       =   None
+        m                   =   self.map
+        linktype,           =   struct.unpack_from(endian + 'H', m, body)
+        units               =   1000000.0
+        tsoffset            =   0
+        option              =   body + 8
 
-        rD                          =   {
-            dpkt.dns.DNS_A          :   'A',
-            dpkt.dns.DNS_AAAA       :   'AAAA',
-            dpkt.dns.DNS_MX         :   'MX',
-            dpkt.dns.DNS_NS         :   'NS',
-            dpkt.dns.DNS_TXT        :   'TXT',
-            dpkt.dns.DNS_CNAME      :   'CNAME',
-            dpkt.dns.DNS_PTR        :   'PTR',
-            dpkt.dns.DNS_SOA        :   'SOA',
-            dpkt.dns.DNS_SRV        :   'SRV',
-            dpkt.dns.DNS_HINFO      :   'HINFO',
-        }
+        while option + 4 <= end:
+            code, length = struct.unpack_from(endian + 'HH', m, option)
+            value = option + 4
 
-        # Ensure we have a clean message
-        if (
-            dns.opcode == dpkt.dns.DNS_QUERY or
-            dns.rcode == dpkt.dns.DNS_RCODE_NOERR or
-            dns.qr == dpkt.dns.DNS_R
-            ):
+            if code == 0 or value + length > end:
+                break
 
-            ##
-            ### Question
-            try:
-                qType               =   dns.qd[0].type
-                qName               =   dns.qd[0].name
-            except IndexError:
-                return False
+            # if_tsresol: power of 10, or of 2 if the high bit is set
+            if code == 9 and length >= 1:
+                resolution  =   ord(m[value])
+                units       =   float(2 ** (resolution & 0x7f) if resolution & 0x80 else 10 ** resolution)
 
-            q['request']            =   qName
+            # if_tsoffset: seconds to add to every timestamp
+            elif code == 14 and length >= 8:
+                tsoffset,   =   struct.unpack_from(endian + 'q', m, value)
 
-            # Match on Query
-            try:
-                q['type']           =   rD[qType]
-            except:
-                pass
+            option = value + ((length + 3) & ~3)
+
+        return linktype, units, tsoffset
+
+    def close(self):
+        if getattr(self, 'map', None) is not None:
+            self.map.close()
+            self.map = None
+        self.handle.close()
+
+
+def describe_file(path = None):
+    """
+    Best effort description of a file for error messages. Uses libmagic if it's
+    installed, imported only now so the happy path never pays for it
+    """
+
+    try:
+        import magic
+        return magic.from_file(path, mime = True)
+    except Exception:
+        return "unknown type"
+
+
+def sniff_capture(path = None):
+    """
+    Validate a capture from its first few dozen bytes and return a CaptureHeader
+
+    Checks the pcap/pcapng magic (which also gives us byte order and, for pcap,
+    the nanosecond variant), the format version, snaplen and link type. pcapng
+    snaplen / link type come from the first interface. Raises on anything we
+    can't read
+    """
+
+    try:
+        with open(path, 'rb') as handle:
+            head = handle.read(28)
+
+            if head[:4] == PcapReader.PCAPNG_MAGIC and head[8:12] in PcapReader.PCAPNG_BYTE_ORDERS:
+                endian          =   PcapReader.PCAPNG_BYTE_ORDERS[head[8:12]]
+                blen,           =   struct.unpack_from(endian + 'I', head, 4)
+
+                handle.seek(blen)
+                idb             =   handle.read(16)
+
+    except(IOError, OSError):
+        raise Exception("Unable to open our file, and/or read from it")
 
-            ##
-            ### Answers
-            q['answers']            =   []
-            for ans in dns.an:
-                a                   =   {}
+    # Classic pcap
+    if len(head) >= 24 and head[:4] in PcapReader.MAGICS:
+        endian, divisor = PcapReader.MAGICS[head[:4]]
+        major, minor, zone, sigfigs, snaplen, linktype = struct.unpack_from(endian + 'HHiIII', head, 4)
 
-                # A Response
-                if ans.type == dpkt.dns.DNS_A:
-                    a['type']       =   'A'
-                    try:
-                        a['data']   =   socket.inet_ntoa(ans.rdata)
-                    except:
-                        continue
+        header = CaptureHeader('pcap', endian, divisor == 1000000000.0, (major, minor), snaplen, linktype)
 
-                # QuadA Response
-                elif ans.type == dpkt.dns.DNS_AAAA:
-                    a['type']       =   'AAAA'
-                    try:
-                        a['data']   =   socket.inet_ntop(socket.AF_INET6, ans.rdata)
-                    except:
-                        continue
+        if major != 2:
+            raise Exception("Unsupported pcap version {0}.{1}".format(major, minor))
 
-                # SOA Response
-                elif ans.type == dpkt.dns.DNS_SOA:
-                    a['type']       =   'SOA'
-                    a['data']       =   ','.join([ ans.mname, ans.rname, str(ans.serial), str(ans.minimum), str(ans.refresh), str(ans.retry), str(ans.expire) ])
+    # pcapng: Section Header Block, then (usually) the first Interface Description Block
+    elif len(head) >= 28 and head[:4] == PcapReader.PCAPNG_MAGIC and head[8:12] in PcapReader.PCAPNG_BYTE_ORDERS:
+        major, minor = struct.unpack_from(endian + 'HH', head, 12)
+        snaplen, linktype = None, None
 
-                elif ans.type == dpkt.dns.DNS_MX:
-                    a['type']       =   'MX'
-                    a['data']       =   ans.mxname
+        if len(idb) == 16:
+            btype, length, linktype, reserved, snaplen = struct.unpack_from(endian + 'IIHHI', idb)
+            if btype != 1:
+                snaplen, linktype = None, None
 
-                elif ans.type == dpkt.dns.DNS_NS:
-                    a['type']       =   'NS'
-                    a['data']       =   ans.nsname
+        header = CaptureHeader('pcapng', endian, False, (major, minor), snaplen, linktype)
 
-                elif ans.type == dpkt.dns.DNS_TXT:
-                    a['type']       =   'TXT'
-                    a['data']       =   ' '.join(ans.text)
+        if major != 1:
+            raise Exception("Unsupported pcapng version {0}.{1}".format(major, minor))
 
-                elif ans.type == dpkt.dns.DNS_CNAME:
-                    a['type']       =   'CNAME'
-                    a['data']       =   ans.cname
+    else:
+        raise Exception("Bad file type ({0}). Must be a pcap or pcapng capture".format(describe_file(path)))
 
-                elif ans.type == dpkt.dns.DNS_PTR:
-                    a['type']       =   'PTR'
-                    a['data']       =   ans.ptrname
+    if header.linktype is not None and header.linktype not in LINK_LAYERS:
+        raise Exception("Unsupported link type {0}".format(header.linktype))
 
-                elif ans.type == dpkt.dns.DNS_HINFO:
-                    a['type']       =   'HINFO'
-                    a['data']       =   ' '.join(ans.text)
+    if header.snaplen == 0 and header.format == 'pcap':
+        raise Exception("Invalid snaplen of 0 in pcap header")
 
-                elif ans.type == dpkt.dns.DNS_SRV:
-                    # Do something with SRV
-                    pass
+    return header
 
 
-                q['answers'].append(a)
+class TCPStream(object):
+    """
+    One direction of a TCP conversation, put back in sequence order
+
+    Contiguous bytes collect in data until a dissector consumes them. Segments
+    from ahead of the gap are parked in pending, retransmitted bytes are trimmed
+    """
 
+    __slots__ = ('seq', 'data', 'pending', 'last', 'gaps')
 
-            # Cleanup and uniquifying
-            self._add_unique_domains(q['request'])
-            self.results['dns'].append(q)
+    def __init__(self, seq, tstamp):
+        self.seq        =   seq
+        self.data       =   ''
+        self.pending    =   {}
+        self.last       =   tstamp
+        self.gaps       =   0
 
-    def _add_host(self, h = None):
+    def add(self, seq, data, tstamp):
         """
-        Add a host to our list of unique hosts
+        Place a segment. Returns True if it made new contiguous data available
         """
-        if h == None:
-            raise Exception("No host passed to _add_host")
+        self.last       =   tstamp
+        offset          =   (seq - self.seq) & 0xffffffff
+
+        # Ahead of us: park it until the gap fills
+        if offset and offset < 0x80000000:
+            self.pending[seq] = data
 
-        s   =   self._convert_string_to_printable(h['src'])
-        d   =   self._convert_string_to_printable(h['dst'])
+            if len(self.pending) <= STREAM_PENDING:
+                return False
 
-        if s not in self.results['hosts']:
-            self.results['hosts'].append(s)
+            # Too much parked: write the gap off and carry on from the earliest segment we hold
+            return self.skip_gap()
 
-        if d not in self.results['hosts']:
-            self.results['hosts'].append(d)
+        # Behind us: retransmission, possibly with some new data on the end
+        if offset:
+            behind = 0x100000000 - offset
+            if behind >= len(data):
+                return False
+            data = data[behind:]
 
+        self.data       +=  data
+        self.seq        =   (self.seq + len(data)) & 0xffffffff
 
+        self._drain()
+        return True
 
-    def _parse_tcp(self, tstamp = None, c = None, data = None):
+    def skip_gap(self):
         """
-        This is more or less a meta routing. We're indicate which methods
-        we want to run against this packet (though they're defined elsewhere)
+        Give up on the missing bytes in front of our earliest parked segment
         """
+        if not self.pending:
+            return False
 
-        ##
-        ### HTTP
-        try:
-            http            =   dpkt.http.Request()
-            http.method     =   False
-            http.uri        =   False
-            http.version    =   False
-            http            =   http.unpack(data)
-            self._tcp_parse_http(c, data)
+        self.gaps       +=  1
+        self.seq        =   min(self.pending, key = lambda s: (s - self.seq) & 0xffffffff)
+        return self._drain()
 
-        except:
+    def _drain(self):
+        """
+        Move any parked segments that now line up onto data
+        """
+        added = False
 
-            # If any of our three fields are set, good enough
-            if http.method or http.uri or http.version:
-                self._tcp_parse_http(c, data)
+        while self.pending:
+            for seq in self.pending:
+                offset = (seq - self.seq) & 0xffffffff
+                if offset == 0 or offset >= 0x80000000:
+                    break
+            else:
+                break
 
+            data = self.pending.pop(seq)
+            if offset:
+                behind = 0x100000000 - offset
+                if behind >= len(data):
+                    continue
+                data = data[behind:]
 
-        ##
-        ### IRC TODO:
+            self.data   +=  data
+            self.seq    =   (self.seq + len(data)) & 0xffffffff
+            added       =   True
 
+        return added
 
-        ##
-        ### SSH - This is a total hack
-        if self.SSHRE1.match(data):
-            self.results['ssh'].append([tstamp, "Potential SSH v2 Client Connection"])
-        elif self.SSHRE2.match(data):
-            self.results['ssh'].append([tstamp, "Potential SSH v2 Server Response"])
 
+class Flow(object):
+    """
+    A single 5-tuple flow. Oriented by the first packet we saw for it,
+    so src/spt is (probably) the initiator
+    """
 
+    __slots__ = ('proto', 'src', 'spt', 'dst', 'dpt', 'first', 'last', 'packets', 'bytes', 'rpackets', 'rbytes', 'index', 'protocol', 'probes', 'streams', 'hits', 'tls')
 
-        ##
-        ### SSL
-        # Normal SSL
-        try:
+    def __init__(self, proto, src, spt, dst, dpt, tstamp, index = 0):
+        self.proto      =   proto
+        self.src        =   src
+        self.spt        =   spt
+        self.dst        =   dst
+        self.dpt        =   dpt
+        self.first      =   tstamp
+        self.last       =   tstamp
 
-            sslStream = isinstance(dpkt.ssl.TLSRecord(data), dpkt.ssl.TLSRecord)
-            if sslStream:
-                if c['spt'] == 443 or c['dpt'] == 443:
-                    self.results['ssl'].append([tstamp, "SSL/TLS Stream Initialization"])
-                elif c['spt'] != 443 or c['dpt'] != 443:
-                    self.results['ssl'].append([tstamp, "SSL/TLS over non-standard port spt: {0} dpt {1}".format(c['spt'], c['dpt'])])
+        # Record number of the packet that opened this flow
+        self.index      =   index
 
-            elif not sslStream:
-                if c['spt'] == 443 or c['dpt']:
-                    self.results['ssl'].append([tstamp, "Non-SSL Stream Detected over port 443", self._convert_string_to_printable(data) ])
+        # Application protocol: None until classified, False once we've given up
+        self.protocol   =   None
+        self.probes     =   0
 
-        except:
-            pass
+        # [forward, reverse] TCPStreams once reassembly starts. A direction we
+        # don't care about is False
+        self.streams    =   None
 
+        # Names of signatures that have already fired on this flow
+        self.hits       =   None
 
-        ##
-        ### Stratrum
-        strat = self.stratumRE.match(data)
-        if strat:
-            info    =   {
-                'user'      :   strat.group(1),
-                'pass'      :   strat.group(2),
-                'payload'   :   self._convert_string_to_printable(data)
-            }
-            self.results['stratum'].append([tstamp, info])
+        # TLSSession, once classified as ssl
+        self.tls        =   None
 
+        # Forward (src -> dst) and reverse (dst -> src) counters
+        self.packets    =   0
+        self.bytes      =   0
+        self.rpackets   =   0
+        self.rbytes     =   0
 
+    def update(self, tstamp, size, reverse = False):
+        """
+        Account for one more packet (size is the transport payload length)
+        """
+        self.last       =   tstamp
 
-        ##
-        ### SMTP
-        if c['dpt'] == 25:
-            self._tcp_build_smtp(c, data)
+        if reverse:
+            self.rpackets   +=  1
+            self.rbytes     +=  size
+        else:
+            self.packets    +=  1
+            self.bytes      +=  size
 
+    def endpoints(self, reverse = False):
+        """
+        The src/dst/spt/dpt dict our dissectors expect, for one direction
+        """
+        if reverse:
+            return {'src' : self.dst, 'dst' : self.src, 'spt' : self.dpt, 'dpt' : self.spt}
+        return {'src' : self.src, 'dst' : self.dst, 'spt' : self.spt, 'dpt' : self.dpt}
 
-    def _parse_udp(self, tstamp = None, c = None, data = None):
+    def direction(self):
         """
-        Just like the TCP parse instance above, this is more or less a meta method
+        'both' if we've seen traffic in each direction, 'oneway' otherwise
         """
+        return 'both' if self.rpackets else 'oneway'
+
+    def as_dict(self):
+        return {
+            'src'       :   self.src,
+            'dst'       :   self.dst,
+            'spt'       :   self.spt,
+            'dpt'       :   self.dpt,
+            'first'     :   self.first,
+            'last'      :   self.last,
+            'packets'   :   self.packets + self.rpackets,
+            'bytes'     :   self.bytes + self.rbytes,
+            'direction' :   self.direction(),
+            'protocol'  :   self.protocol or None,
+        }
 
-        ##
-        ### DNS
-        try:
-            dpkt.dns.DNS(data)
-            self._udp_parse_dns(data)
-        except:
-            pass
+class TLSSession(object):
+    """
+    What we've learnt from one flow's TLS handshake. Each direction is done once
+    its interesting messages are in (or the handshake turns encrypted), after
+    which its segments are no longer reassembled
+    """
+
+    __slots__ = ('first', 'client', 'server', 'subject', 'issuer', 'side', 'buffers', 'done', 'reported')
+
+    def __init__(self, tstamp):
+        self.first      =   tstamp
+
+        # Decoded ClientHello / ServerHello, and the leaf certificate's names
+        self.client     =   None
+        self.server     =   None
+        self.subject    =   None
+        self.issuer     =   None
+
+        # Direction the ClientHello travelled in (0 is flow src -> dst)
+        self.side       =   None
+
+        # Handshake bytes not yet forming a whole message, per direction
+        self.buffers    =   ['', '']
+        self.done       =   [False, False]
+        self.reported   =   False
+
+
+class Echo(object):
+    """
+    ICMP echo traffic between a requester and a target under one identifier.
+    Replies are paired with requests by sequence number for round trip times
+    """
+
+    __slots__ = ('version', 'src', 'dst', 'ident', 'first', 'last', 'index', 'requests', 'replies', 'bytes', 'rbytes',
+                 'largest', 'sizes', 'pending', 'answered', 'mismatched', 'rttmin', 'rttmax', 'rtttotal')
+
+    def __init__(self, version, src, dst, ident, tstamp, index = 0):
+        self.version    =   version
+        self.src        =   src
+        self.dst        =   dst
+        self.ident      =   ident
+        self.first      =   tstamp
+        self.last       =   tstamp
+        self.index      =   index
+
+        # Requests (src -> dst) and replies, payload bytes of each
+        self.requests   =   0
+        self.replies    =   0
+        self.bytes      =   0
+        self.rbytes     =   0
+
+        # Payload sizes seen (up to ICMP_SIZE_VARIETY + 1 of them), and the largest
+        self.largest    =   0
+        self.sizes      =   set()
+
+        # Unanswered requests, seq -> (timestamp, size)
+        self.pending    =   {}
+
+        self.answered   =   0
+        self.mismatched =   0
+        self.rttmin     =   None
+        self.rttmax     =   None
+        self.rtttotal   =   0.0
+
+    def _size(self, size):
+        if size > self.largest:
+            self.largest = size
+        if len(self.sizes) <= ICMP_SIZE_VARIETY:
+            self.sizes.add(size)
+
+    def request(self, tstamp, seq, size):
+        self.last       =   tstamp
+        self.requests   +=  1
+        self.bytes      +=  size
+        self._size(size)
+
+        # Nobody's answering: stop holding on to them
+        if len(self.pending) >= ICMP_PENDING:
+            self.pending.clear()
+        self.pending[seq] = (tstamp, size)
+
+    def reply(self, tstamp, seq, size):
+        self.last       =   tstamp
+        self.replies    +=  1
+        self.rbytes     +=  size
+        self._size(size)
+
+        sent = self.pending.pop(seq, None)
+        if sent is None:
+            return
+
+        rtt             =   tstamp - sent[0]
+        self.answered   +=  1
+        self.rtttotal   +=  rtt
+        self.rttmin     =   rtt if self.rttmin is None else min(self.rttmin, rtt)
+        self.rttmax     =   rtt if self.rttmax is None else max(self.rttmax, rtt)
+
+        if size != sent[1]:
+            self.mismatched += 1
+
+    def anomalies(self):
+        """
+        Reasons this looks more like a tunnel than ping
+        """
+        found = []
+
+        if self.largest > ICMP_TUNNEL_SIZE:
+            found.append("large payload")
+        if len(self.sizes) > ICMP_SIZE_VARIETY:
+            found.append("varying payload sizes")
+        if self.mismatched:
+            found.append("replies differ from requests")
+
+        return found
+
+    def as_dict(self):
+        return {
+            'src'           :   self.src,
+            'dst'           :   self.dst,
+            'id'            :   self.ident,
+            'protocol'      :   'icmp' if self.version == 4 else 'icmp6',
+            'first'         :   self.first,
+            'last'          :   self.last,
+            'requests'      :   self.requests,
+            'replies'       :   self.replies,
+            'unanswered'    :   max(self.requests - self.answered, 0),
+            'bytes'         :   self.bytes,
+            'rbytes'        :   self.rbytes,
+            'largest'       :   self.largest,
+            'rtt_min'       :   self.rttmin,
+            'rtt_avg'       :   self.rtttotal / self.answered if self.answered else None,
+            'rtt_max'       :   self.rttmax,
+            'anomalies'     :   self.anomalies(),
+        }
+
+
+class Stats(object):
+    """
+    Optional instrumentation for a packetsummary run: packets and bytes per
+    protocol, decode failures and swallowed exceptions per stage, and calls and
+    cumulative time per dissector. Shards each keep their own and merge() them
+    """
+
+    def __init__(self):
+        self.packets        =   {}
+        self.bytes          =   {}
+        self.applications   =   {}
+        self.failures       =   {}
+        self.exceptions     =   {}
+        self.dissectors     =   {}
+        self.seconds        =   0.0
 
+    def count(self, protocol, size):
+        self.packets[protocol]  =   self.packets.get(protocol, 0) + 1
+        self.bytes[protocol]    =   self.bytes.get(protocol, 0) + size
 
-    def _parse_icmp(self, c = None, data = None):
+    def application(self, protocol):
+        self.applications[protocol] = self.applications.get(protocol, 0) + 1
+
+    def failure(self, stage, error = None):
+        """
+        A dissector gave up on its input. error is the exception it swallowed, if any
         """
+        self.failures[stage] = self.failures.get(stage, 0) + 1
 
+        if error is not None:
+            key = (stage, type(error).__name__)
+            self.exceptions[key] = self.exceptions.get(key, 0) + 1
+
+    def timed(self, name, method):
+        """
+        Wrap a bound method so its calls and inclusive time are recorded under name
         """
 
+        tally = self.dissectors.setdefault(name, [0, 0.0])
+        clock = timeit.default_timer
 
+        def wrapper(*args, **kwargs):
+            started = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                tally[0] += 1
+                tally[1] += clock() - started
+
+        return wrapper
 
-    def run(self):
+    def merge(self, other):
         """
-        Attempt analysis on the file we've got set
+        Fold another Stats (eg: from a shard) into this one
         """
 
-        # Open a DPKT reader
-        try:
-            handle = open(self.path, 'rb')
-            pcap = dpkt.pcap.Reader(handle)
-        except(IOError, OSError):
-            raise Exception("Unable to open our file, and/or read from it")
+        for name in ('packets', 'bytes', 'applications', 'failures', 'exceptions'):
+            mine = getattr(self, name)
+            for key, value in getattr(other, name).iteritems():
+                mine[key] = mine.get(key, 0) + value
+
+        for name, (calls, seconds) in other.dissectors.iteritems():
+            tally = self.dissectors.setdefault(name, [0, 0.0])
+            tally[0] += calls
+            tally[1] += seconds
+
+    def as_dict(self):
+        exceptions = {}
+        for (stage, error), count in self.exceptions.iteritems():
+            exceptions.setdefault(stage, {})[error] = count
+
+        return {
+            'packets'           :   dict(self.packets),
+            'bytes'             :   dict(self.bytes),
+            'applications'      :   dict(self.applications),
+            'decode_failures'   :   dict(self.failures),
+            'exceptions'        :   exceptions,
+            'dissectors'        :   dict((name, {'calls' : calls, 'seconds' : seconds}) for name, (calls, seconds) in self.dissectors.iteritems()),
+            'seconds'           :   self.seconds,
+        }
 
-        # Loop through our capture, one packet at a time
-        for timestamp, buff in pcap:
-            # try:
+    def prometheus(self, prefix = 'packetsummary'):
+        """
+        Render as Prometheus text exposition format
+        """
 
-            # Get packet data
-            eth                 =   dpkt.ethernet.Ethernet(buff)
-            ip                  =   eth.data
+        label   =   lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        lines   =   []
 
-            # Define var for this packet
-            c                   =   {}
+        def metric(name, kind, text, samples):
+            lines.append("# HELP {0}_{1} {2}".format(prefix, name, text))
+            lines.append("# TYPE {0}_{1} {2}".format(prefix, name, kind))
+            for labels, value in samples:
+                tags = ','.join('{0}="{1}"'.format(k, label(v)) for k, v in labels)
+                lines.append("{0}_{1}{2} {3}".format(prefix, name, '{' + tags + '}' if tags else '', repr(value) if isinstance(value, float) else value))
 
-            # Packet is IPv4
-            if isinstance(ip, dpkt.ip.IP):
-                c['src']        =   socket.inet_ntoa(ip.src)
-                c['dst']        =   socket.inet_ntoa(ip.dst)
+        metric('packets_total', 'counter', "Packets seen, by protocol", [((('protocol', k),), v) for k, v in sorted(self.packets.iteritems())])
+        metric('bytes_total', 'counter', "Bytes seen, by protocol", [((('protocol', k),), v) for k, v in sorted(self.bytes.iteritems())])
+        metric('application_packets_total', 'counter', "TCP payload packets, by classified application protocol", [((('protocol', k),), v) for k, v in sorted(self.applications.iteritems())])
+        metric('decode_failures_total', 'counter', "Inputs a dissector gave up on, by stage", [((('stage', k),), v) for k, v in sorted(self.failures.iteritems())])
+        metric('exceptions_total', 'counter', "Exceptions caught and swallowed, by stage and type", [((('stage', k[0]), ('exception', k[1])), v) for k, v in sorted(self.exceptions.iteritems())])
+        metric('dissector_calls_total', 'counter', "Dissector invocations", [((('dissector', k),), v[0]) for k, v in sorted(self.dissectors.iteritems())])
+        metric('dissector_seconds_total', 'counter', "Cumulative (inclusive) time spent in each dissector", [((('dissector', k),), v[1]) for k, v in sorted(self.dissectors.iteritems())])
+        metric('run_seconds', 'gauge', "Wall time of the last run", [((), self.seconds)])
 
-            # Packet is IPv6
-            elif isinstance(ip, dpkt.ip6.IP6):
-                c['src']        =   socket.inet_ntop(socket.AF_INET6, ip.src)
-                c['dst']        =   socket.inet_ntop(socket.AF_INET6, ip.dst)
+        return "\n".join(lines) + "\n"
 
-            # Unknown type, go to next packet
-            else:
-                continue
 
-            # Attempt to add a new host
-            self._add_host(c)
+class packetsummary(object):
+    """
+    Accepts a filepath (and optionally a signatures rules file or SignatureSet, a
+    packet filter expression, see packetfilter.py, a checkpoint file to resume
+    from and save to, a start/end timestamp window, and whether to collect Stats),
+    returns a dict
+    Raises an exceptions on errors
+    """
 
-            # Handle TCP Processing
-            if ip.p == dpkt.ip.IP_PROTO_TCP:
+    def __init__(self, path = None, signatures = None, packet_filter = None, checkpoint = None, start = None, end = None, stats = False, cache = None):
+        """
+        Initialize
+        """
 
-                # Get data
-                tcp             =   ip.data
-                if not isinstance(tcp, dpkt.tcp.TCP):
-                    tcp         =   dpkt.tcp.TCP(tcp)
+        if path == None:
+            raise Exception("No filepath to our pcap specified")
 
-                # Ensure we actually have data to work with (eg: not an empty packet)
-                if len(tcp.data) > 0:
-                    c['spt']    =   tcp.sport
-                    c['dpt']    =   tcp.dport
+        if not os.path.exists(path):
+            raise Exception("Filepath {0} doesn't exist".format(path))
 
-                    # TCP connection: add it to our timeline
-                    self.results['tcp_connections'].append(c)
+        if os.path.getsize(path) == 0:
+            raise Exception("The file supplied is zero bytes in size...")
 
-                    # Process our TCP packet
-                    self._parse_tcp(timestamp, c, tcp.data)
+        # Validate the file header ourselves, and keep what it tells us
+        header                  =   sniff_capture(path)
 
-                else:
-                    continue
+        self.format             =   header.format
+        self.endian             =   header.endian
+        self.nanosecond         =   header.nanosecond
+        self.version            =   header.version
+        self.snaplen            =   header.snaplen
+        self.linktype           =   header.linktype
 
+        # Set our instance vars
+        self.path               =   path
 
-            # Handle UDP Processing
-            elif ip.p == dpkt.ip.IP_PROTO_UDP:
+        # Flows with live TCPStreams, least recently active first
+        self._streamFlows       =   OrderedDict()
+        self._nextSweep         =   None
 
-                # Get data
-                udp             =   ip.data
-                if not isinstance(udp, dpkt.udp.UDP):
-                    udp         =   dpkt.udp.UDP(udp)
+        # Streaming state. Events for the packet being processed are queued here
+        # and drained by iter_events(), so the queue never outgrows one packet
+        self._events            =   deque()
 
-                # Ensure we actually have data to work with (eg: not an empty packet)
-                if len(udp.data) > 0:
-                    c['spt']    =   udp.sport
-                    c['dpt']    =   udp.dport
+        # Unique hosts and domains, value -> [first seen, packets, record]. OrderedDicts give
+        # us constant time membership checks while keeping first-seen output order
+        self.hosts              =   OrderedDict()
+        self.domains            =   OrderedDict()
 
-                    # udp connection: add it to our timeline
-                    self.results['udp_connections'].append(c)
+        # DNS: raw message (sans ID) -> decoded record, and the (request, type) aggregate run() reports
+        self._dnsCache          =   OrderedDict()
+        self._dnsTable          =   {}
 
-                    # Process our udp packet
-                    self._parse_udp(timestamp, c, udp.data)
+        # Record number of the packet being processed (orders merged shard output)
+        self._index             =   0
+        self._recordCount       =   0
+        self._connections       =   False
 
-                else:
-                    continue
+        # 5-tuple flow table, (proto, src, spt, dst, dpt) -> Flow. Ordered so output is deterministic
+        self.flows              =   OrderedDict()
 
+        # ICMP aggregates: (requester, target, id) -> Echo, and
+        # (reporter, sender, original dst, proto, port, version, code) -> [record, entry]
+        self.echoes             =   OrderedDict()
+        self.unreachable        =   OrderedDict()
 
-            # Handle ICMP Processing
-            elif ip.p == dpkt.ip.IP_PROTO_ICMP:
+        self.stratumRE          =   STRATUM_RE
+        self.SSHRE1             =   SSH_CLIENT_RE
+        self.SSHRE2             =   SSH_SERVER_RE
 
-                # Get data
-                icmp                =   ip.data
-                if not isinstance(icmp, dpkt.icmp.ICMP):
-                    icmp            =   dpkt.icmp.ICMP(icmp)
+        # User supplied payload signatures, scanned over every TCP/UDP payload
+        if isinstance(signatures, basestring):
+            signatures          =   SignatureSet(signatures)
+        self.signatures         =   signatures
 
-                # Process ICMP
-                #self._parse_icmp(c, icmp)
+        # Optional BPF-like filter, tested against raw header bytes before any decoding
+        self.filterExpression   =   packet_filter
+        self.packetFilter       =   compile_filter(packet_filter) if packet_filter else None
 
+        # Only records with start <= timestamp <= end are analyzed
+        self.start              =   start
+        self.end                =   end
 
+        # Where the last pass stopped reading (see PcapReader.resume)
+        self.checkpoint         =   checkpoint
+        self._position          =   None
+        self._context           =   None
 
-            # # Handle exceptions
-            # except AttributeError, dpkt.dpkt.NeedData:
-            #     continue
-            # except Exception as e:
-            #     print "exception: {0}".format(e)
+        # Instrumentation. Off, this costs one None check per packet
+        self.stats              =   Stats() if stats else None
 
+        if self.stats is not None:
+            for name in DISSECTORS:
+                setattr(self, name, self.stats.timed(name, getattr(self, name)))
 
-        # Close our handle
-        handle.close()
+        # Summaries of captures we've seen before (a ResultCache, see resultcache.py)
+        self.cache              =   cache
 
-        # Cleanup
-        self._tcp_build_smtp(reassemble = True)
+        # Define our result skeleton
+        self.results            =   {
 
-        # Return
-        return self.results
+            # Hosts
+            'hosts'             :   [],
+            'host_stats'        :   OrderedDict(),
 
+            # Domain
+            'domains'           :   [],
+            'dns'               :   [],
 
+            # HTTP
+            'http'              :   [],
 
-if __name__ == "__main__":
-    import sys
-    import json
-    summary = packetsummary(sys.argv[1])
+            # Flows
+            'tcp_connections'   :   [],
+            'udp_connections'   :   [],
+            'icmp_requests'     :   [],
+            'icmp_unreachable'  :   [],
+
+            # Application traffic
+            'smtp'              :   [],
+            'irc'               :   [],
+            'stratum'           :   [],
+            'ssl'               :   [],
+            'ssh'               :   [],
+            'signatures'        :   [],
+        }
+
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self._restore_checkpoint()
+
+    def _convert_string_to_printable(self, s = None):
+        """
+        Ensure that the passed string contains only printable characters.
+        If it doesn't, convert those that aren't to hex
+
+        Anything past PRINTABLE_LIMIT bytes is dropped and replaced with a note
+        saying how much was cut
+        """
+        extra = len(s) - PRINTABLE_LIMIT
+        if extra > 0:
+            s = s[:PRINTABLE_LIMIT]
+
+        # dpkt hands some fields (method, uri, version) back as unicode
+        if isinstance(s, unicode):
+            r = NONPRINTABLE_RE.sub(lambda m: "\\x%02x" % ord(m.group()), s)
+
+        else:
+
+            # Deleting every printable byte leaves only the ones we need to escape
+            bad = s.translate(None, string.printable)
+
+            if not bad:
+                r = s
+
+            # Mostly text: only touch the odd byte out
+            elif len(bad) * 8 < len(s):
+                r = NONPRINTABLE_RE.sub(lambda m: PRINTABLE_ESCAPES[ord(m.group())], s)
+
+            # Mostly binary: escape the whole buffer through the table
+            else:
+                r = ''.join(map(PRINTABLE_ESCAPES.__getitem__, bytearray(s)))
+
+        if extra > 0:
+            r += "...({0} more bytes)".format(extra)
+
+        return r
+
+    def _emit(self, kind, tstamp, data):
+        """
+        Queue an event for the packet currently being processed
+        """
+        self._events.append(PacketEvent(kind, tstamp, data))
+
+    def _collect(self, event):
+        """
+        Fold a single event back into our result skeleton (used by run())
+        """
+
+        if event.type == 'dns':
+            self._aggregate_dns(event)
+            return
+
+        self.results[EVENT_TYPES[event.type]].append(event.data)
+
+    def _aggregate_dns(self, event):
+        """
+        results['dns'] holds one entry per (request, type), in first-seen order,
+        with its distinct answers and how often it was seen
+        """
+
+        q       =   event.data
+        key     =   (q['request'], q.get('type'))
+        entry   =   self._dnsTable.get(key)
+
+        if entry is None:
+            entry   =   {
+                'request'       :   q['request'],
+                'type'          :   q.get('type'),
+                'answers'       :   [],
+                'count'         :   0,
+                'first_seen'    :   event.timestamp,
+                'last_seen'     :   event.timestamp,
+            }
+            self._dnsTable[key] = (entry, set())
+            self.results['dns'].append(entry)
+        else:
+            entry = entry[0]
+
+        seen                =   self._dnsTable[key][1]
+        entry['count']      +=  1
+        entry['last_seen']  =   event.timestamp
+
+        for answer in q['answers']:
+            a = (answer['type'], answer['data'])
+            if a not in seen:
+                seen.add(a)
+                entry['answers'].append(answer)
+
+    def _tcp_parse_http(self, tstamp = None, c = None, data = None):
+        """
+        Extract HTTP Flow information and add it to our results
+        We've opted to re-parse the data portion of our packet as our check sets valid defaults to False
+        """
+
+        try:
+            http            =   dpkt.http.Request()
+            http.unpack(data)
+        except Exception as e:
+            self._failed('http', e)
+
+        try:
+
+            flow            =   {
+                'host'          :   None,
+                'port'          :   c['spt'],
+                'payload'       :   self._convert_string_to_printable(data),
+
+                # https://docs.python.org/2/library/urlparse.html#urlparse.urlunparse
+                'uri'           :   None,
+                'body'          :   self._convert_string_to_printable(http.body),
+                'path'          :   self._convert_string_to_printable(http.uri),
+                'user-agent'    :   self._convert_string_to_printable(http.headers['user-agent']) if 'user-agent' in http.headers else None,
+                'version'       :   self._convert_string_to_printable(http.version),
+                'method'        :   self._convert_string_to_printable(http.method)
+            }
+
+            # Check for a host
+            if 'host' in http.headers:
+                flow['host'] = self._convert_string_to_printable(http.headers['host'])
+
+            # Build our URI
+            flow['uri']         =   self._convert_string_to_printable(urlparse.urlunparse(
+                    (
+                        'http',
+                        flow['host'],
+                        http.uri,
+                        None,
+                        None,
+                        None
+                    )
+                ))
+
+            # Add our flow to our results
+            self._emit('http', tstamp, flow)
+
+        except Exception as e:
+            self._failed('http-fields', e)
+
+    def _tcp_stream_wanted(self, flow = None, c = None, data = None, d = 0):
+        """
+        Decide whether a direction is worth reassembling, from its first payload
+        """
+
+        # Only until the handshake is over, and only from a handshake record
+        if flow.protocol == 'ssl':
+            return not flow.tls.done[d] and data[:1] == '\x16'
+
+        if flow.protocol == 'http':
+            return data[:16].split(' ', 1)[0] in HTTP_METHODS
+
+        # Client side only, as before
+        if flow.protocol == 'smtp':
+            return c['dpt'] == 25
+
+        # Both directions; servers push the interesting commands to bots
+        return flow.protocol == 'irc'
+
+    def _tcp_reassemble(self, tstamp = None, c = None, data = None, flow = None, seq = 0, reverse = False):
+        """
+        Add a segment to its flow's stream and feed whatever became contiguous
+        to the protocol's stream dissector
+        """
+
+        if flow.streams is None:
+            flow.streams = [None, None]
+
+        d       =   1 if reverse else 0
+        stream  =   flow.streams[d]
+
+        # Quiet for too long: whatever is there is as complete as it'll get
+        if stream and tstamp - stream.last > STREAM_IDLE:
+            self._tcp_stream_close(flow, d)
+            stream = None
+
+        if stream is None:
+            if not self._tcp_stream_wanted(flow, c, data, d):
+                flow.streams[d] = False
+                return
+
+            stream = flow.streams[d] = TCPStream(seq, tstamp)
+
+        elif stream is False:
+            return
+
+        # Most recently active flows live at the end
+        self._streamFlows.pop(flow, None)
+        self._streamFlows[flow] = True
+
+        if stream.add(seq, data, tstamp):
+            self._tcp_stream_dissect(tstamp, flow, d)
+
+            # Dissector couldn't make sense of it within our budget, force it through
+            if len(stream.data) > STREAM_LIMIT:
+                self._tcp_stream_dissect(tstamp, flow, d, final = True)
+                stream.data = ''
+
+    def _tcp_stream_dissect(self, tstamp = None, flow = None, d = 0, final = False):
+        """
+        Run one direction's buffered data through its stream dissector. Dissectors
+        consume complete messages from stream.data and leave the remainder
+        """
+
+        stream  =   flow.streams[d]
+        c       =   flow.endpoints(d == 1)
+
+        if flow.protocol == 'http':
+            self._tcp_stream_http(tstamp, c, stream, final)
+        elif flow.protocol == 'smtp':
+            self._tcp_stream_smtp(tstamp, c, stream, final)
+        elif flow.protocol == 'irc':
+            self._tcp_stream_irc(tstamp, c, stream, final)
+        elif flow.protocol == 'ssl':
+            self._tcp_stream_ssl(tstamp, flow, d, stream, final)
+
+    def _tcp_stream_close(self, flow = None, d = 0):
+        """
+        Flush one direction of a flow (FIN, RST, idle or end of capture) and free it
+        """
+
+        stream = flow.streams[d]
+
+        if stream:
+
+            # Nothing's coming to fill the holes now
+            while stream.pending:
+                stream.skip_gap()
+
+            self._tcp_stream_dissect(stream.last, flow, d, final = True)
+            flow.streams[d] = None
+
+        if not flow.streams[0] and not flow.streams[1]:
+            self._streamFlows.pop(flow, None)
+
+            # Nothing more is coming for this handshake
+            if flow.tls is not None and not flow.tls.reported:
+                self._tls_report(flow)
+
+    def _tcp_sweep_streams(self, tstamp = None):
+        """
+        Close streams that have gone quiet, so abandoned flows don't pin memory
+        """
+
+        while self._streamFlows:
+            flow = next(iter(self._streamFlows))
+
+            # Flows are ordered on stream data, so bare ACKs (flow.last) don't count
+            last = max([stream.last for stream in flow.streams if stream] or [flow.last])
+            if tstamp - last <= STREAM_IDLE:
+                break
+
+            self._tcp_stream_close(flow, 0)
+            self._tcp_stream_close(flow, 1)
+            self._streamFlows.pop(flow, None)
+
+    def _tcp_stream_http(self, tstamp = None, c = None, stream = None, final = False):
+        """
+        Cut complete requests (headers plus Content-Length bytes of body) off
+        the front of a client stream
+        """
+
+        while stream.data:
+            data = stream.data
+
+            # Lost our place (eg: a body we couldn't size). Drop until the next flush
+            if data[:16].split(' ', 1)[0] not in HTTP_METHODS:
+                stream.data = ''
+                return
+
+            end = data.find('\r\n\r\n')
+            if end < 0:
+                if final:
+                    self._tcp_parse_http(tstamp, c, data)
+                    stream.data = ''
+                return
+
+            length  =   CONTENT_LENGTH_RE.search(data, 0, end + 2)
+            total   =   end + 4 + (int(length.group(1)) if length else 0)
+
+            if len(data) < total and not final:
+                return
+
+            self._tcp_parse_http(tstamp, c, data[:total])
+            stream.data = data[total:]
+
+    def _tcp_stream_smtp(self, tstamp = None, c = None, stream = None, final = False):
+        """
+        Report a client's SMTP conversation once it's over
+        """
+
+        if not final:
+            return
+
+        # New session
+        if stream.data.startswith("HELO") or stream.data.startswith("EHLO"):
+            self._emit('smtp', tstamp, {"dest":c['dst'], "payload":self._convert_string_to_printable(stream.data)})
+
+        stream.data = ''
+
+    def _tcp_stream_irc(self, tstamp = None, c = None, stream = None, final = False):
+        """
+        Pick the commands we care about out of complete IRC lines
+        """
+
+        lines = stream.data.split('\n')
+
+        # Keep a trailing partial line for next time
+        stream.data = '' if final else lines.pop()
+
+        for line in lines:
+            line    =   line.rstrip('\r')
+            prefix  =   None
+
+            if line.startswith(':'):
+                prefix, _, line = line[1:].partition(' ')
+
+            command, _, params = line.partition(' ')
+            command = command.upper()
+
+            if command in IRC_COMMANDS:
+                info    =   {
+                    'src'       :   c['src'],
+                    'dst'       :   c['dst'],
+                    'dpt'       :   c['dpt'],
+                    'prefix'    :   self._convert_string_to_printable(prefix) if prefix else None,
+                    'command'   :   command,
+                    'params'    :   self._convert_string_to_printable(params),
+                }
+                self._emit('irc', tstamp, [tstamp, info])
+
+    def _tcp_stream_ssl(self, tstamp = None, flow = None, d = 0, stream = None, final = False):
+        """
+        Consume whole TLS records off the front of a stream, feeding handshake
+        records through _tls_handshake. The direction is done as soon as it has
+        said all we care about, or stops speaking plaintext handshake
+        """
+
+        tls     =   flow.tls
+        data    =   stream.data
+        offset  =   0
+        done    =   False
+
+        while len(data) - offset >= 5 and not done:
+            content, major, length = struct.unpack_from('>BBxH', data, offset)
+
+            # Not (or no longer) TLS
+            if not 20 <= content <= 24 or major != 3:
+                self._failed('tls')
+                done = True
+                break
+
+            if offset + 5 + length > len(data):
+                break
+
+            body    =   data[offset + 5:offset + 5 + length]
+            offset  +=  5 + length
+
+            # ChangeCipherSpec, alerts, application data: whatever follows is encrypted
+            if content != 22:
+                done = True
+            else:
+                done = self._tls_handshake(flow, d, body)
+
+        stream.data = data[offset:]
+
+        if done or final:
+            tls.done[d]         =   True
+            tls.buffers[d]      =   ''
+            stream.data         =   ''
+            flow.streams[d]     =   False
+
+            if tls.done[0] and tls.done[1]:
+                self._streamFlows.pop(flow, None)
+                if not tls.reported:
+                    self._tls_report(flow)
+
+    def _tls_handshake(self, flow = None, d = 0, body = None):
+        """
+        Add a handshake record's body to the direction's buffer and decode any
+        whole messages. Returns True once the direction has nothing more for us
+        """
+
+        tls     =   flow.tls
+        buff    =   tls.buffers[d] + body
+        done    =   False
+
+        while len(buff) >= 4 and not done:
+            kind, = struct.unpack_from('B', buff)
+            length, = struct.unpack('>I', '\x00' + buff[1:4])
+
+            if len(buff) < 4 + length:
+                break
+
+            message, buff = buff[4:4 + length], buff[4 + length:]
+
+            # ClientHello: all we want from the client
+            if kind == 1:
+                tls.client, tls.side, done = tls_client_hello(message), d, True
+                if tls.client is None:
+                    self._failed('tls-client-hello')
+
+            # ServerHello. From TLS 1.3 on, the rest of the handshake is encrypted
+            elif kind == 2:
+                tls.server = tls_server_hello(message)
+                if tls.server is None:
+                    self._failed('tls-server-hello')
+                elif tls.server['version'] == TLS_VERSIONS[0x0304]:
+                    done = True
+
+            # Certificate: the leaf is first
+            elif kind == 11:
+                names = tls_certificate(message)
+                if names is None:
+                    self._failed('tls-certificate')
+                else:
+                    tls.subject, tls.issuer = names
+                done = True
+
+            # ServerHelloDone
+            elif kind == 14:
+                done = True
+
+        # A handshake message this big is something else
+        if len(buff) > STREAM_LIMIT:
+            done = True
+
+        tls.buffers[d] = buff
+        return done
+
+    def _tls_report(self, flow = None):
+        """
+        Emit the single ssl event for a flow: SNI, versions, JA3 / JA3S and certificate names
+        """
+
+        tls             =   flow.tls
+        tls.reported    =   True
+        c               =   flow.endpoints(tls.side == 1)
+
+        if c['spt'] == 443 or c['dpt'] == 443:
+            note = "SSL/TLS Stream Initialization"
+        else:
+            note = "SSL/TLS over non-standard port spt: {0} dpt {1}".format(c['spt'], c['dpt'])
+
+        client  =   tls.client or {}
+        server  =   tls.server or {}
+        text    =   lambda s: self._convert_string_to_printable(s) if s is not None else None
+
+        info    =   {
+            'src'           :   c['src'],
+            'dst'           :   c['dst'],
+            'spt'           :   c['spt'],
+            'dpt'           :   c['dpt'],
+            'version'       :   server.get('version') or client.get('version'),
+            'sni'           :   text(client.get('sni')),
+            'alpn'          :   [text(p) for p in client.get('alpn', [])],
+            'ja3'           :   client.get('ja3'),
+            'ja3_hash'      :   client.get('ja3_hash'),
+            'ja3s'          :   server.get('ja3s'),
+            'ja3s_hash'     :   server.get('ja3s_hash'),
+            'cipher'        :   server.get('cipher'),
+            'subject'       :   text(tls.subject),
+            'issuer'        :   text(tls.issuer),
+        }
+
+        self._emit('ssl', tls.first, [tls.first, note, info])
+
+    def _add_unique_domains(self, tstamp = None, domain = None):
+        """
+        Attempt to add domain to our set of unique domains
+        """
+        seen = self.domains.get(domain)
+
+        if seen is None:
+            self.domains[domain] = [tstamp, 1, self._index]
+        else:
+            seen[1] += 1
+
+    def _udp_parse_dns(self, tstamp = None, data = None):
+        """
+        Parse all DNS stuffery and emit it as a dns event
+
+        Decoded messages are cached on everything but the transaction ID, so a
+        beacon repeating the same lookup is only ever decoded once
+        """
+
+        key     =   data[2:]
+        q       =   self._dnsCache.pop(key, DNS_UNCACHED)
+
+        if q is DNS_UNCACHED:
+            q   =   self._udp_decode_dns(data)
+
+            # Failed decodes aren't worth a cache slot
+            if q is None:
+                return False
+
+            # Least recently used entries fall off the front
+            if len(self._dnsCache) >= DNS_CACHE_SIZE:
+                self._dnsCache.popitem(last = False)
+
+        self._dnsCache[key] = q
+
+        # Cleanup and uniquifying
+        self._add_unique_domains(tstamp, q['request'])
+
+        # Each event gets its own copy, so a consumer annotating one can't reach the cache
+        self._emit('dns', tstamp, dict(q, answers = [dict(a) for a in q['answers']]))
+
+    def _udp_decode_dns(self, data = None):
+        """
+        Decode a DNS message into our {request, type, answers} record
+        Returns None for anything that isn't a usable message
+        """
+
+        try:
+            dns                     =   dpkt.dns.DNS(data)
+        except Exception as e:
+            self._failed('dns', e)
+            return None
+
+        # Ensure we have a clean message
+        if not (
+            dns.opcode == dpkt.dns.DNS_QUERY or
+            dns.rcode == dpkt.dns.DNS_RCODE_NOERR or
+            dns.qr == dpkt.dns.DNS_R
+            ):
+            return None
+
+        ##
+        ### Question
+        try:
+            q                       =   {'request' : dns.qd[0].name}
+        except IndexError:
+            return None
+
+        # Match on Query
+        if dns.qd[0].type in DNS_TYPES:
+            q['type']               =   DNS_TYPES[dns.qd[0].type]
+
+        ##
+        ### Answers
+        q['answers']                =   []
+        for ans in dns.an:
+
+            decode                  =   DNS_ANSWER_DECODERS.get(ans.type)
+            if decode is None:
+                continue
+
+            try:
+                q['answers'].append({'type' : DNS_TYPES[ans.type], 'data' : decode(ans)})
+            except Exception as e:
+                self._failed('dns-answer', e)
+                continue
+
+        return q
+
+    def _add_host(self, tstamp = None, h = None):
+        """
+        Count a packet against each host, emitting a host event the first time we see one
+        Addresses come from inet_ntoa/inet_ntop, so they're already printable
+        """
+        if h == None:
+            raise Exception("No host passed to _add_host")
+
+        for host in (h['src'], h['dst']):
+            seen = self.hosts.get(host)
+
+            if seen is None:
+                self.hosts[host] = [tstamp, 1, self._index]
+                self._emit('host', tstamp, host)
+            else:
+                seen[1] += 1
+
+
+
+    def _match_signatures(self, tstamp = None, proto = None, c = None, data = None, flow = None):
+        """
+        Run a payload past our signatures. Each rule is reported once per flow
+        """
+
+        for rule, match in self.signatures.scan(data, proto):
+
+            if flow.hits is None:
+                flow.hits = set()
+            elif rule.name in flow.hits:
+                continue
+            flow.hits.add(rule.name)
+
+            hit     =   {
+                'rule'          :   rule.name,
+                'description'   :   rule.description,
+                'src'           :   c['src'],
+                'dst'           :   c['dst'],
+                'spt'           :   c['spt'],
+                'dpt'           :   c['dpt'],
+                'groups'        :   [self._convert_string_to_printable(g) for g in match.groups() if g is not None] if match else [],
+                'payload'       :   self._convert_string_to_printable(data),
+            }
+            self._emit('signature', tstamp, [tstamp, hit])
+
+    def _update_flow(self, tstamp = None, proto = None, c = None, size = 0):
+        """
+        Find (or create) the flow this packet belongs to and account for it
+        Both directions of a conversation land on the same Flow
+        """
+
+        key         =   (proto, c['src'], c['spt'], c['dst'], c['dpt'])
+        flow        =   self.flows.get(key)
+
+        if flow is not None:
+            flow.update(tstamp, size)
+            return flow
+
+        flow        =   self.flows.get((proto, c['dst'], c['dpt'], c['src'], c['spt']))
+        if flow is not None:
+            flow.update(tstamp, size, reverse = True)
+            return flow
+
+        flow        =   Flow(proto, c['src'], c['spt'], c['dst'], c['dpt'], tstamp, self._index)
+        flow.update(tstamp, size)
+        self.flows[key] = flow
+        return flow
+
+    def _flush_flows(self):
+        """
+        Yield a connection event per flow (if asked for) and drop the table
+        Events are handed out one at a time rather than queued, as there's one per flow
+        """
+
+        if self._connections:
+            for flow in self.flows.itervalues():
+                yield PacketEvent(flow.proto, flow.first, flow.as_dict())
+
+        self.flows.clear()
+
+    def _classify_tcp(self, c = None, data = None):
+        """
+        Pick the one dissector a TCP payload belongs to from its ports and first
+        few bytes. Returns None if nothing matches
+        """
+
+        if c['spt'] == 25 or c['dpt'] == 25:
+            return 'smtp'
+
+        if data.startswith('SSH-'):
+            return 'ssh'
+
+        # TLS record header: content type, then a 3.x version
+        if len(data) >= 5 and data[0] in TLS_CONTENT_TYPES and data[1] == '\x03':
+            return 'ssl'
+
+        if data[:16].split(' ', 1)[0] in HTTP_METHODS:
+            return 'http'
+
+        if data[:5] in ('NICK ', 'USER ', 'PASS ') or c['spt'] in IRC_PORTS or c['dpt'] in IRC_PORTS:
+            return 'irc'
+
+        if data.startswith('{') and 'mining.' in data:
+            return 'stratum'
+
+        return None
+
+    def _parse_tcp(self, tstamp = None, c = None, data = None, flow = None, seq = 0):
+        """
+        This is more or less a meta routing. Each flow is classified once (see
+        _classify_tcp) and from then on its payloads go to exactly one dissector.
+        HTTP, SMTP and IRC dissectors work on reassembled streams
+        """
+
+        ##
+        ### Classification
+        proto = flow.protocol
+
+        if proto is None:
+            proto = self._classify_tcp(c, data)
+
+            # SSL is reported once, when its handshake is done or the flow closes (see _tls_report)
+            if proto == 'ssl':
+                flow.tls = TLSSession(tstamp)
+
+            elif flow.probes == 0 and (c['spt'] == 443 or c['dpt'] == 443):
+                self._emit('ssl', tstamp, [tstamp, "Non-SSL Stream Detected over port 443", self._convert_string_to_printable(data) ])
+
+            if proto is not None:
+                flow.protocol = proto
+            else:
+                flow.probes += 1
+                if flow.probes >= CLASSIFY_PROBES:
+                    flow.protocol = False
+                return
+
+
+        ##
+        ### HTTP, SMTP, IRC
+        if proto in STREAM_PROTOCOLS:
+            reverse = c['src'] != flow.src or c['spt'] != flow.spt
+            self._tcp_reassemble(tstamp, c, data, flow, seq, reverse)
+
+
+        ##
+        ### SSH - This is a total hack. Only the banners are worth looking at
+        elif proto == 'ssh':
+            if not data.startswith('SSH-'):
+                pass
+            elif self.SSHRE1.match(data):
+                self._emit('ssh', tstamp, [tstamp, "Potential SSH v2 Client Connection"])
+            elif self.SSHRE2.match(data):
+                self._emit('ssh', tstamp, [tstamp, "Potential SSH v2 Server Response"])
+
+
+        ##
+        ### Stratrum
+        elif proto == 'stratum':
+            strat = self.stratumRE.match(data)
+            if strat:
+                info    =   {
+                    'user'      :   strat.group(1),
+                    'pass'      :   strat.group(2),
+                    'payload'   :   self._convert_string_to_printable(data)
+                }
+                self._emit('stratum', tstamp, [tstamp, info])
+
+
+    def _parse_udp(self, tstamp = None, c = None, data = None):
+        """
+        Just like the TCP parse instance above, this is more or less a meta method
+        """
+
+        ##
+        ### DNS
+        if c['spt'] in DNS_PORTS or c['dpt'] in DNS_PORTS or dns_plausible(data):
+            self._udp_parse_dns(tstamp, data)
+
+
+    def _parse_icmp(self, tstamp = None, c = None, buff = None, start = 0, end = 0, version = 4):
+        """
+        Aggregate one ICMP / ICMPv6 message, read in place from buff[start:end]
+        Echoes are paired up per session, unreachables are counted per original destination
+        """
+
+        if end - start < 8:
+            self._failed('icmp')
+            return
+
+        kind, code              =   struct.unpack_from('BB', buff, start)
+        request, reply, unreach =   ICMP_TYPES[version]
+
+        ##
+        ### Echo
+        if kind == request or kind == reply:
+            ident, seq = struct.unpack_from('>HH', buff, start + 4)
+
+            if kind == request:
+                key = (c['src'], c['dst'], ident)
+            else:
+                key = (c['dst'], c['src'], ident)
+
+            echo = self.echoes.get(key)
+            if echo is None:
+                echo = self.echoes[key] = Echo(version, key[0], key[1], ident, tstamp, self._index)
+
+            if kind == request:
+                echo.request(tstamp, seq, end - start - 8)
+            else:
+                echo.reply(tstamp, seq, end - start - 8)
+
+        ##
+        ### Unreachable: the message quotes the header of the datagram that bounced
+        elif kind == unreach:
+            header = ip_header(buff, version, start + 8)
+            if header is None:
+                self._failed('icmp-unreachable')
+                return
+
+            proto, src, dst, transport, quoted, first = header
+
+            port = None
+            if first and proto in (dpkt.ip.IP_PROTO_TCP, dpkt.ip.IP_PROTO_UDP) and transport + 4 <= len(buff):
+                port, = struct.unpack_from('>H', buff, transport + 2)
+
+            family  =   socket.AF_INET if version == 4 else socket.AF_INET6
+            target  =   socket.inet_ntop(family, dst)
+            key     =   (c['src'], c['dst'], target, proto, port, version, code)
+            seen    =   self.unreachable.get(key)
+
+            if seen is None:
+                self.unreachable[key] = [self._index, {
+                    'reporter'      :   c['src'],
+                    'src'           :   c['dst'],
+                    'dst'           :   target,
+                    'protocol'      :   IP_PROTOCOL_NAMES.get(proto, proto),
+                    'port'          :   port,
+                    'code'          :   code,
+                    'reason'        :   ICMP_UNREACHABLE[version].get(code, 'unknown'),
+                    'count'         :   1,
+                    'first_seen'    :   tstamp,
+                    'last_seen'     :   tstamp,
+                }]
+            else:
+                seen[1]['count']        +=  1
+                seen[1]['last_seen']    =   tstamp
+
+    def _flush_icmp(self):
+        """
+        Yield the echo and unreachable aggregates and drop them
+        """
+
+        for echo in self.echoes.itervalues():
+            yield PacketEvent('icmp', echo.first, echo.as_dict())
+
+        for index, entry in self.unreachable.itervalues():
+            yield PacketEvent('icmp_unreachable', entry['first_seen'], entry)
+
+        self.echoes.clear()
+        self.unreachable.clear()
+
+
+
+    def _process_packet(self, timestamp, buff, linktype = 1):
+        """
+        Decode a single frame and route it to our dissectors
+        Anything worth reporting is queued through _emit()
+        """
+
+        # Periodically let go of streams that have gone quiet
+        if self._nextSweep is None or timestamp >= self._nextSweep:
+            self._tcp_sweep_streams(timestamp)
+            self._nextSweep =   timestamp + STREAM_IDLE
+
+        # Get packet data. We skip straight to the IP header for every link type,
+        # rather than building (and throwing away) a link layer object
+        located             =   locate_ip(buff, linktype)
+        if located is None:
+            if self.stats is not None:
+                self.stats.count('non-ip', len(buff))
+            return
+
+        version, offset     =   located
+
+        # ICMP never needs dpkt: read it where it lies
+        if (buff[offset + 9:offset + 10] == '\x01') if version == 4 else (buff[offset + 6:offset + 7] in ICMP6_NEXT):
+            header = ip_header(buff, version, offset)
+
+            if header is not None and header[0] in ICMP_PROTOCOLS:
+                proto, src, dst, transport, end, first = header
+                family = socket.AF_INET if version == 4 else socket.AF_INET6
+
+                c = {'src' : socket.inet_ntop(family, src), 'dst' : socket.inet_ntop(family, dst)}
+                self._add_host(timestamp, c)
+
+                if self.stats is not None:
+                    self.stats.count(IP_PROTOCOL_NAMES[proto], len(buff))
+
+                # Later fragments carry no ICMP header
+                if first:
+                    self._parse_icmp(timestamp, c, buff, transport, end, version)
+                return
+
+        try:
+            if version == 4:
+                ip          =   dpkt.ip.IP(buff[offset:])
+            else:
+                ip          =   dpkt.ip6.IP6(buff[offset:])
+        except (dpkt.UnpackError, struct.error, ValueError) as e:
+            self._failed('ip', e)
+            return
+
+        if self.stats is not None:
+            self.stats.count(IP_PROTOCOL_NAMES.get(ip.p, 'ip-other'), len(buff))
+
+        # Define var for this packet
+        c                   =   {}
+
+        # Packet is IPv4
+        if isinstance(ip, dpkt.ip.IP):
+            c['src']        =   socket.inet_ntoa(ip.src)
+            c['dst']        =   socket.inet_ntoa(ip.dst)
+
+        # Packet is IPv6
+        elif isinstance(ip, dpkt.ip6.IP6):
+            c['src']        =   socket.inet_ntop(socket.AF_INET6, ip.src)
+            c['dst']        =   socket.inet_ntop(socket.AF_INET6, ip.dst)
+
+        # Unknown type, go to next packet
+        else:
+            return
+
+        # Attempt to add a new host
+        self._add_host(timestamp, c)
+
+        # Handle TCP Processing
+        if ip.p == dpkt.ip.IP_PROTO_TCP:
+
+            # Get data
+            tcp             =   ip.data
+            if not isinstance(tcp, dpkt.tcp.TCP):
+
+                # Truncated or corrupt header: skip the packet, not the capture
+                try:
+                    tcp     =   dpkt.tcp.TCP(tcp)
+                except (dpkt.UnpackError, dpkt.NeedData, struct.error) as e:
+                    self._failed('tcp', e)
+                    return
+
+            c['spt']        =   tcp.sport
+            c['dpt']        =   tcp.dport
+
+            # TCP connection: account for it in our flow table
+            flow            =   self._update_flow(timestamp, 'tcp', c, len(tcp.data))
+
+            if self.signatures and tcp.data:
+                self._match_signatures(timestamp, 'tcp', c, tcp.data, flow)
+
+            # Ensure we actually have data to work with (eg: not an empty packet)
+            # and that the flow hasn't already been written off
+            if len(tcp.data) > 0 and flow.protocol is not False:
+
+                # Process our TCP packet
+                self._parse_tcp(timestamp, c, tcp.data, flow, tcp.seq)
+
+                if self.stats is not None:
+                    self.stats.application(flow.protocol or 'unknown')
+
+            # Connection's over, flush what we've reassembled
+            if flow.streams and tcp.flags & (dpkt.tcp.TH_FIN | dpkt.tcp.TH_RST):
+                if tcp.flags & dpkt.tcp.TH_RST:
+                    self._tcp_stream_close(flow, 0)
+                    self._tcp_stream_close(flow, 1)
+                else:
+                    self._tcp_stream_close(flow, 1 if c['src'] != flow.src or c['spt'] != flow.spt else 0)
+
+
+        # Handle UDP Processing
+        elif ip.p == dpkt.ip.IP_PROTO_UDP:
+
+            # Get data
+            udp             =   ip.data
+            if not isinstance(udp, dpkt.udp.UDP):
+
+                try:
+                    udp     =   dpkt.udp.UDP(udp)
+                except (dpkt.UnpackError, dpkt.NeedData, struct.error) as e:
+                    self._failed('udp', e)
+                    return
+
+            c['spt']        =   udp.sport
+            c['dpt']        =   udp.dport
+
+            # udp connection: account for it in our flow table
+            flow            =   self._update_flow(timestamp, 'udp', c, len(udp.data))
+
+            if self.signatures and udp.data:
+                self._match_signatures(timestamp, 'udp', c, udp.data, flow)
+
+            # Ensure we actually have data to work with (eg: not an empty packet)
+            if len(udp.data) > 0:
+
+                # Process our udp packet
+                self._parse_udp(timestamp, c, udp.data)
+
+    def _records(self):
+        """
+        Yield (timestamp, frame, link type) for every record in our capture
+        """
+
+        pcap = PcapReader(self.path, self.start, self.end)
+
+        if self._position is not None:
+            pcap.resume(self._position, self._context)
+
+        try:
+            for record in pcap:
+                self._recordCount += 1
+                yield record
+
+        finally:
+            self._position  =   pcap.position
+            self._context   =   pcap.context
+
+            # Close our handle (and unmap the file)
+            pcap.close()
+
+    def _sample(self, length):
+        """
+        crc32 of the first length bytes of our capture
+        """
+
+        with open(self.path, 'rb') as handle:
+            return zlib.crc32(handle.read(length)) & 0xffffffff
+
+    def save_checkpoint(self, path = None):
+        """
+        Write where we stopped reading, plus every table and result gathered so
+        far, so a later run can pick up with only the records appended since.
+        Open streams and flows are saved as they are rather than flushed
+        """
+
+        path    =   path or self.checkpoint
+        length  =   min(CHECKPOINT_SAMPLE, self._position or 0)
+
+        state   =   {
+            'version'       :   CHECKPOINT_VERSION,
+            'filter'        :   self.filterExpression,
+            'sample'        :   (length, self._sample(length)),
+            'position'      :   self._position,
+            'context'       :   self._context,
+            'records'       :   self._recordCount,
+            'hosts'         :   self.hosts,
+            'domains'       :   self.domains,
+            'flows'         :   self.flows,
+            'streamFlows'   :   self._streamFlows,
+            'nextSweep'     :   self._nextSweep,
+            'dnsTable'      :   self._dnsTable,
+            'echoes'        :   self.echoes,
+            'unreachable'   :   self.unreachable,
+            'results'       :   self.results,
+        }
+
+        # Write then rename, so a crash never leaves half a checkpoint behind
+        try:
+            with open(path + '.tmp', 'wb') as handle:
+                pickle.dump(state, handle, pickle.HIGHEST_PROTOCOL)
+            os.rename(path + '.tmp', path)
+        except(IOError, OSError):
+            raise Exception("Unable to write checkpoint {0}".format(path))
+
+    def _restore_checkpoint(self):
+        """
+        Load state saved by save_checkpoint(). A checkpoint for a capture that has
+        since been rotated (shrunk, or different leading bytes) is ignored
+        """
+
+        try:
+            with open(self.checkpoint, 'rb') as handle:
+                state = pickle.load(handle)
+        except Exception as e:
+            raise Exception("Unable to read checkpoint {0}: {1}".format(self.checkpoint, e))
+
+        if not isinstance(state, dict) or state.get('version') != CHECKPOINT_VERSION:
+            raise Exception("Checkpoint {0} was written by an incompatible version".format(self.checkpoint))
+
+        if state['filter'] != self.filterExpression:
+            raise Exception("Checkpoint {0} was taken with a different packet filter".format(self.checkpoint))
+
+        length, crc = state['sample']
+
+        if state['position'] > os.path.getsize(self.path) or self._sample(length) != crc:
+            return
+
+        self._position          =   state['position']
+        self._context           =   state['context']
+        self._recordCount       =   state['records']
+        self.hosts              =   state['hosts']
+        self.domains            =   state['domains']
+        self.flows              =   state['flows']
+        self._streamFlows       =   state['streamFlows']
+        self._nextSweep         =   state['nextSweep']
+        self._dnsTable          =   state['dnsTable']
+        self.echoes             =   state['echoes']
+        self.unreachable        =   state['unreachable']
+        self.results            =   state['results']
+
+    def _failed(self, stage, error = None):
+        """
+        Account for a decode failure (and the exception we swallowed), when instrumenting
+        """
+        if self.stats is not None:
+            self.stats.failure(stage, error)
+
+    def _drain_events(self):
+        """
+        Yield (and forget) whatever events are queued
+        """
+
+        while self._events:
+            yield self._events.popleft()
+
+    def _filtered(self, buff, linktype):
+        """
+        Does this raw frame pass our packet filter? Non-IP frames never do
+        """
+
+        fields = ip_fields(buff, linktype)
+        return fields is not None and self.packetFilter(fields)
+
+    def _flush_streams(self):
+        """
+        End of capture: push every stream we're still holding through its dissector,
+        yielding what each flow's streams produce before moving on to the next
+        """
+
+        for flow in self.flows.itervalues():
+            if flow.streams:
+                self._tcp_stream_close(flow, 0)
+                self._tcp_stream_close(flow, 1)
+
+                for event in self._drain_events():
+                    yield event
+
+    def iter_events(self, connections = False):
+        """
+        Walk our capture and yield PacketEvents as packets are parsed
+
+        Nothing is accumulated in self.results, so memory stays flat regardless
+        of capture size (only the unique host/domain tables, the flow table and
+        capped stream buffers are kept, which grow with hosts and flows rather than packets).
+        If connections is True we also emit one tcp/udp event per flow once the
+        capture is done
+
+        With a checkpoint, nothing is flushed at the end: open streams and flows are
+        saved instead, and the next pass carries on from the first new record
+        """
+
+        self._connections   =   connections
+
+        # Loop through our capture, one packet at a time
+        for self._index, (timestamp, buff, linktype) in enumerate(self._records(), self._recordCount):
+
+            if self.packetFilter is not None and not self._filtered(buff, linktype):
+                if self.stats is not None:
+                    self.stats.count('filtered', len(buff))
+                continue
+
+            self._process_packet(timestamp, buff, linktype)
+
+            # Hand off whatever this packet produced
+            for event in self._drain_events():
+                yield event
+
+        if self.checkpoint is not None:
+            self.save_checkpoint()
+            return
+
+        # Cleanup
+        for event in self._flush():
+            yield event
+
+    def _flush(self):
+        """
+        End of capture: close out open streams, then report flows, lazily
+        """
+
+        for flush in (self._flush_streams, self._flush_flows, self._flush_icmp):
+            for event in flush():
+                yield event
+
+    def _run_shard(self, shard, shards):
+        """
+        Process only the packets whose flow hashes to this shard and return
+        everything the parent needs to merge it with its siblings
+
+        Events are tagged with their record number. Streams still open at the end
+        are flushed here, tagged to sort after every packet in flow table order,
+        just as a single pass would flush them
+        """
+
+        self._connections   =   True
+        events              =   []
+
+        for self._index, (timestamp, buff, linktype) in enumerate(self._records()):
+
+            if shard_of(buff, shards, linktype) != shard:
+                continue
+
+            if self.packetFilter is not None and not self._filtered(buff, linktype):
+                if self.stats is not None:
+                    self.stats.count('filtered', len(buff))
+                continue
+
+            self._process_packet(timestamp, buff, linktype)
+
+            for event in self._events:
+                events.append((self._index, event))
+            self._events.clear()
+
+        total = self._recordCount
+
+        for flow in self.flows.itervalues():
+            if flow.streams:
+                self._tcp_stream_close(flow, 0)
+                self._tcp_stream_close(flow, 1)
+
+                for event in self._events:
+                    events.append((total + flow.index, event))
+                self._events.clear()
+
+        return {
+            'events'    :   events,
+            'hosts'     :   self.hosts.items(),
+            'domains'   :   self.domains.items(),
+            'flows'     :   [(f.index, f.proto, f.first, f.as_dict()) for f in self.flows.itervalues()],
+            'echoes'    :   [(e.index, 'icmp', e.first, e.as_dict()) for e in self.echoes.itervalues()],
+            'unreachable':  [(index, 'icmp_unreachable', entry['first_seen'], entry) for index, entry in self.unreachable.itervalues()],
+            'stats'     :   self.stats,
+        }
+
+    def _merge_shards(self, shards):
+        """
+        Fold per-shard output back together in capture order. Every packet (and
+        so every event, flow and first sighting) belongs to exactly one shard, so
+        ordering by record number reproduces what a single pass would produce
+        """
+
+        # Unique tables: earliest sighting wins, counters add up
+        for name in ('hosts', 'domains'):
+            merged = {}
+
+            for result in shards:
+                for position, (value, (first, count, index)) in enumerate(result[name]):
+                    seen = merged.get(value)
+
+                    if seen is None:
+                        merged[value] = [first, count, index, position]
+                    else:
+                        seen[1] += count
+                        if (index, position) < (seen[2], seen[3]):
+                            seen[0], seen[2], seen[3] = first, index, position
+
+            table = getattr(self, name)
+            for value, (first, count, index, position) in sorted(merged.iteritems(), key = lambda i: (i[1][2], i[1][3])):
+                table[value] = [first, count, index]
+
+        events = []
+        for result in shards:
+            events.extend(result['events'])
+
+        flows, echoes, unreachable = [], [], []
+        for result in shards:
+            flows.extend(result['flows'])
+            echoes.extend(result['echoes'])
+            unreachable.extend(result['unreachable'])
+
+        # Stable sorts, so events from the same packet keep their relative order
+        # Host events are skipped: each shard reports its own first sightings
+        for index, event in sorted(events, key = lambda e: e[0]):
+            if event.type != 'host':
+                self._collect(event)
+
+        for table in (flows, echoes, unreachable):
+            for index, kind, first, record in sorted(table, key = lambda f: f[0]):
+                self._collect(PacketEvent(kind, first, record))
+
+        if self.stats is not None:
+            for result in shards:
+                self.stats.merge(result['stats'])
+
+    def run(self, workers = 1):
+        """
+        Attempt analysis on the file we've got set
+        With workers > 1, packets are sharded by flow across a process pool
+        A capture already summarized with these options comes from the cache instead
+        """
+
+        key, text = self._cache_lookup()
+        if text is not None:
+            self.results = json.loads(text)
+            return self.results
+
+        return self._analyze(workers, key)
+
+    def run_json(self, workers = 1):
+        """
+        run()'s summary as JSON text. A cached summary is handed back as stored, undecoded
+        """
+
+        key, text = self._cache_lookup()
+        if text is not None:
+            return text
+
+        return json.dumps(self._analyze(workers, key))
+
+    def _cache_lookup(self):
+        """
+        (cache key, stored JSON text or None). The key is None if this run can't use the
+        cache: checkpointed runs depend on earlier passes, and stats describe this run
+        """
+
+        if self.cache is None or self.checkpoint is not None or self.stats is not None:
+            return None, None
+
+        key = (self.cache.digest(self.path), self._cache_kind(), CACHE_VERSION)
+        found, text = self.cache.get(*key)
+
+        return key, text if found else None
+
+    def _analyze(self, workers = 1, key = None):
+        """
+        Do the actual work of run(), storing the summary under key if we have one
+        """
+
+        started = timeit.default_timer()
+
+        if workers > 1:
+            if self.checkpoint is not None:
+                raise Exception("Checkpoints can't be combined with workers")
+
+            options = (self.signatures, self.filterExpression, self.start, self.end, self.stats is not None)
+
+            pool = multiprocessing.Pool(workers)
+            try:
+                shards = pool.map(_run_shard, [(self.path, options, shard, workers) for shard in range(workers)])
+            finally:
+                pool.close()
+                pool.join()
+
+            self._merge_shards(shards)
+
+        else:
+            for event in self.iter_events(connections = True):
+                self._collect(event)
+
+            # Still open streams and flows go in this summary, but stay open in the checkpoint
+            if self.checkpoint is not None:
+                for event in self._flush():
+                    self._collect(event)
+
+        # Unique collections, in first-seen order
+        self.results['hosts']   = self.hosts.keys()
+        self.results['domains'] = self.domains.keys()
+
+        for host, (first, packets, index) in self.hosts.iteritems():
+            self.results['host_stats'][host] = {'first_seen' : first, 'packets' : packets}
+
+        if self.stats is not None:
+            self.stats.seconds      =   timeit.default_timer() - started
+            self.results['stats']   =   self.stats.as_dict()
+
+        if key is not None:
+            digest, kind, version = key
+            self.cache.put(digest, kind, version, json.dumps(self.results))
+
+        # Return
+        return self.results
+
+    def _cache_kind(self):
+        """
+        Cache key for the options that change what run() reports (workers don't)
+        """
+        rules   = self.signatures.__getstate__() if self.signatures is not None else None
+        options = pickle.dumps((rules, self.filterExpression, self.start, self.end), pickle.HIGHEST_PROTOCOL)
+        return 'packetsummary:' + hashlib.sha1(options).hexdigest()
+
+    def write_columnar(self, path = None):
+        """
+        Stream our summary into a columnar file (see columnar.py) rather than building
+        self.results. Tables are named as run()'s results keys; per-event tables are
+        written as events arrive, the unique tables (hosts, domains, dns) at the end
+        """
+
+        started = timeit.default_timer()
+        writer  = ColumnarWriter(path)
+
+        def append(event):
+            if event.type == 'dns':
+                self._aggregate_dns(event)
+                return
+
+            # Already covered by host_stats
+            if event.type == 'host':
+                return
+
+            data = event.data
+            if isinstance(data, list):
+                data = dict(zip(COLUMNAR_FIELDS[event.type], data))
+
+            writer.append(EVENT_TYPES[event.type], flatten(data))
+
+        for event in self.iter_events(connections = True):
+            append(event)
+
+        if self.checkpoint is not None:
+            for event in self._flush():
+                append(event)
+
+        for host, (first, packets, index) in self.hosts.iteritems():
+            writer.append('host_stats', {'host' : host, 'first_seen' : first, 'packets' : packets})
+
+        for domain, (first, count, index) in self.domains.iteritems():
+            writer.append('domains', {'domain' : domain, 'first_seen' : first, 'count' : count})
+
+        for entry in self.results['dns']:
+            writer.append('dns', entry)
+
+        meta = {
+            'path'      :   self.path,
+            'format'    :   self.format,
+            'linktype'  :   self.linktype,
+            'filter'    :   self.filterExpression,
+            'start'     :   self.start,
+            'end'       :   self.end,
+        }
+
+        if self.stats is not None:
+            self.stats.seconds  =   timeit.default_timer() - started
+            meta['stats']       =   self.stats.as_dict()
+
+        writer.close(meta)
+
+
+def _locate_ethernet(buff):
+    """
+    Ethernet II, walking past any 802.1Q / QinQ tags
+    """
+    offset = 12
+    etype, = struct.unpack_from('>H', buff, offset)
+
+    while etype in (0x8100, 0x88a8):
+        offset += 4
+        etype, = struct.unpack_from('>H', buff, offset)
+
+    return ETHERTYPES.get(etype), offset + 2
+
+
+def _locate_sll(buff):
+    """
+    Linux "cooked" capture v1: 16 byte header, protocol last
+    """
+    etype, = struct.unpack_from('>H', buff, 14)
+    return ETHERTYPES.get(etype), 16
+
+
+def _locate_sll2(buff):
+    """
+    Linux "cooked" capture v2: 20 byte header, protocol first
+    """
+    etype, = struct.unpack_from('>H', buff, 0)
+    return ETHERTYPES.get(etype), 20
+
+
+def _locate_null(buff):
+    """
+    BSD loopback: 4 byte address family, in whichever byte order the capturing host used
+    """
+    family, = struct.unpack_from('<I', buff, 0)
+    if family > 0xffff:
+        family, = struct.unpack_from('>I', buff, 0)
+
+    if family == socket.AF_INET:
+        return 4, 4
+    if family in (10, 24, 28, 30):
+        return 6, 4
+    return None, 4
+
+
+def _locate_raw(buff):
+    """
+    Bare IP, tell v4 from v6 by the version nibble
+    """
+    version = ord(buff[0]) >> 4
+    return version if version in (4, 6) else None, 0
+
+
+# Ethertype -> IP version
+ETHERTYPES              =   {
+    0x0800              :   4,
+    0x86dd              :   6,
+}
+
+# Link type -> function returning (IP version, offset of the IP header) for a frame
+LINK_LAYERS             =   {
+    0                   :   _locate_null,           # LINKTYPE_NULL
+    1                   :   _locate_ethernet,       # LINKTYPE_ETHERNET
+    12                  :   _locate_raw,            # DLT_RAW (OpenBSD)
+    14                  :   _locate_raw,            # DLT_RAW (BSD/OS)
+    101                 :   _locate_raw,            # LINKTYPE_RAW
+    108                 :   _locate_null,           # LINKTYPE_LOOP
+    113                 :   _locate_sll,            # LINKTYPE_LINUX_SLL
+    228                 :   lambda buff: (4, 0),    # LINKTYPE_IPV4
+    229                 :   lambda buff: (6, 0),    # LINKTYPE_IPV6
+    276                 :   _locate_sll2,           # LINKTYPE_LINUX_SLL2
+}
+
+
+def locate_ip(buff, linktype = 1):
+    """
+    Find the IP header in a raw frame without building any dpkt objects
+    Returns (version, offset), or None if the frame doesn't carry IP
+    """
+
+    locate = LINK_LAYERS.get(linktype)
+    if locate is None:
+        return None
+
+    try:
+        version, offset = locate(buff)
+    except (struct.error, IndexError):
+        return None
+
+    if version is None or offset >= len(buff):
+        return None
+
+    return version, offset
+
+
+def _tls_extensions(body, offset):
+    """
+    Yield (type, value) for each extension in a hello, from the extensions length on
+    """
+
+    if offset + 2 > len(body):
+        return
+
+    total, = struct.unpack_from('>H', body, offset)
+    offset += 2
+    end = min(offset + total, len(body))
+
+    while offset + 4 <= end:
+        kind, length = struct.unpack_from('>HH', body, offset)
+        yield kind, body[offset + 4:offset + 4 + length]
+        offset += 4 + length
+
+
+def tls_client_hello(body):
+    """
+    Decode a ClientHello: best version offered, SNI, ALPN and the JA3 fingerprint
+    Returns None if it's malformed
+    """
+
+    try:
+        version, = struct.unpack_from('>H', body)
+        offset = 34
+        offset += 1 + ord(body[offset])
+
+        length, = struct.unpack_from('>H', body, offset)
+        ciphers = struct.unpack_from('>%dH' % (length // 2), body, offset + 2)
+        offset += 2 + length
+        offset += 1 + ord(body[offset])
+
+        extensions, groups, points, versions, alpn, sni = [], (), '', (), [], None
+
+        for kind, value in _tls_extensions(body, offset):
+            extensions.append(kind)
+
+            # server_name: list length, name type, name length, name
+            if kind == 0 and len(value) >= 5:
+                size, = struct.unpack_from('>H', value, 3)
+                sni = value[5:5 + size]
+
+            elif kind == 10 and len(value) >= 2:
+                groups = struct.unpack_from('>%dH' % (struct.unpack_from('>H', value)[0] // 2), value, 2)
+
+            elif kind == 11 and value:
+                points = value[1:1 + ord(value[0])]
+
+            elif kind == 16 and len(value) >= 2:
+                position = 2
+                while position < len(value):
+                    size = ord(value[position])
+                    alpn.append(value[position + 1:position + 1 + size])
+                    position += 1 + size
+
+            elif kind == 43 and value:
+                versions = struct.unpack_from('>%dH' % (ord(value[0]) // 2), value, 1)
+
+    except (IndexError, struct.error):
+        return None
+
+    keep    =   lambda values: '-'.join(str(v) for v in values if v not in TLS_GREASE)
+    ja3     =   ','.join([str(version), keep(ciphers), keep(extensions), keep(groups), '-'.join(str(ord(p)) for p in points)])
+    best    =   max([v for v in versions if v not in TLS_GREASE] or [version])
+
+    return {
+        'version'   :   TLS_VERSIONS.get(best, hex(best)),
+        'sni'       :   sni,
+        'alpn'      :   alpn,
+        'ja3'       :   ja3,
+        'ja3_hash'  :   hashlib.md5(ja3).hexdigest(),
+    }
+
+
+def tls_server_hello(body):
+    """
+    Decode a ServerHello: negotiated version and cipher, and the JA3S fingerprint
+    Returns None if it's malformed
+    """
+
+    try:
+        version, = struct.unpack_from('>H', body)
+        offset = 34
+        offset += 1 + ord(body[offset])
+
+        cipher, = struct.unpack_from('>H', body, offset)
+        offset += 3
+
+        extensions, selected = [], version
+
+        for kind, value in _tls_extensions(body, offset):
+            extensions.append(kind)
+
+            # supported_versions: the version actually negotiated (TLS 1.3)
+            if kind == 43 and len(value) >= 2:
+                selected, = struct.unpack_from('>H', value)
+
+    except (IndexError, struct.error):
+        return None
+
+    ja3s = ','.join([str(version), str(cipher), '-'.join(str(e) for e in extensions if e not in TLS_GREASE)])
+
+    return {
+        'version'   :   TLS_VERSIONS.get(selected, hex(selected)),
+        'cipher'    :   '0x%04x' % cipher,
+        'ja3s'      :   ja3s,
+        'ja3s_hash' :   hashlib.md5(ja3s).hexdigest(),
+    }
+
+
+def _der(data, offset):
+    """
+    (tag, content start, content end) of the DER element at offset
+    """
+
+    tag, length = struct.unpack_from('BB', data, offset)
+    offset += 2
+
+    if length & 0x80:
+        count, length = length & 0x7f, 0
+        for byte in data[offset:offset + count]:
+            length = (length << 8) | ord(byte)
+        offset += count
+
+    if offset + length > len(data):
+        raise IndexError("DER element runs past its container")
+
+    return tag, offset, offset + length
+
+
+def _x509_name(data, offset, end):
+    """
+    Render an X.509 Name as 'CN=..., O=...', in certificate order
+    """
+
+    parts = []
+
+    # SEQUENCE OF SET OF SEQUENCE { OID, value }
+    while offset < end:
+        tag, start, stop = _der(data, offset)
+        offset = stop
+
+        while start < stop:
+            tag, inner, close = _der(data, start)
+            start = close
+
+            tag, oid, value = _der(data, inner)
+            name = X509_ATTRIBUTES.get(data[oid:value])
+
+            tag, value, finish = _der(data, value)
+            if name is None:
+                continue
+
+            text = data[value:finish]
+            if tag == 0x1e:
+                text = text.decode('utf-16-be', 'replace').encode('utf-8')
+
+            parts.append("{0}={1}".format(name, text))
+
+    return ', '.join(parts)
+
+
+def tls_certificate(body):
+    """
+    (subject, issuer) of the first (leaf) certificate in a Certificate message
+    Returns None if it's malformed
+    """
+
+    try:
+        length, = struct.unpack('>I', '\x00' + body[3:6])
+        cert = body[6:6 + length]
+
+        # Certificate -> TBSCertificate
+        tag, offset, end = _der(cert, 0)
+        tag, offset, end = _der(cert, offset)
+
+        # Optional [0] version, then serial and signature algorithm
+        tag, start, stop = _der(cert, offset)
+        if tag == 0xa0:
+            offset = stop
+        for field in range(2):
+            offset = _der(cert, offset)[2]
+
+        tag, start, stop = _der(cert, offset)
+        issuer = _x509_name(cert, start, stop)
+
+        # Validity, then subject
+        offset = _der(cert, stop)[2]
+        tag, start, stop = _der(cert, offset)
+        subject = _x509_name(cert, start, stop)
+
+    except (IndexError, struct.error, UnicodeError):
+        return None
+
+    return subject, issuer
+
+
+def ip_header(buff, version, offset):
+    """
+    Read the IP header at offset in place: (proto, src, dst, transport offset, end, first fragment)
+
+    IPv6 extension headers are stepped over, so proto is the upper layer protocol.
+    Addresses are packed bytes, end is where the IP payload stops (link layer
+    padding excluded), and first is False for anything but the first fragment.
+    Returns None for truncated headers
+    """
+
+    try:
+
+        # IPv4
+        if version == 4:
+            ihl             =   (ord(buff[offset]) & 0x0f) * 4
+            length, frag    =   struct.unpack_from('>H2xH', buff, offset + 2)
+            proto           =   ord(buff[offset + 9])
+            src             =   buff[offset + 12:offset + 16]
+            dst             =   buff[offset + 16:offset + 20]
+            first           =   frag & 0x1fff == 0
+            end             =   offset + length if length else len(buff)
+            offset          +=  ihl
+
+        # IPv6, walking any extension headers
+        else:
+            length, proto   =   struct.unpack_from('>HB', buff, offset + 4)
+            src             =   buff[offset + 8:offset + 24]
+            dst             =   buff[offset + 24:offset + 40]
+            first           =   True
+            end             =   offset + 40 + length if length else len(buff)
+            offset          +=  40
+
+            while proto in IP6_EXTENSIONS:
+                following   =   ord(buff[offset])
+
+                # Fragment headers are always 8 bytes; note where the fragment sits
+                if proto == 44:
+                    first   =   first and struct.unpack_from('>H', buff, offset + 2)[0] & 0xfff8 == 0
+                    size    =   8
+
+                # AH counts 4 byte words (less 2), everything else 8 byte words (less 1)
+                elif proto == 51:
+                    size    =   (ord(buff[offset + 1]) + 2) * 4
+                else:
+                    size    =   (ord(buff[offset + 1]) + 1) * 8
+
+                proto       =   following
+                offset      +=  size
+
+    except (IndexError, struct.error):
+        return None
+
+    if len(dst) != len(src) or offset > len(buff):
+        return None
+
+    return proto, src, dst, offset, min(end, len(buff)), first
+
+
+def dns_plausible(data):
+    """
+    Cheap check that a UDP payload off the usual DNS ports starts like a standard
+    query or response: a single question, no reserved bits, sane record counts and
+    a valid first label length. Saves a full decode of every other UDP payload
+    """
+
+    if len(data) < 17:
+        return False
+
+    flags, qdcount, ancount, nscount, arcount = struct.unpack_from('>HHHHH', data, 2)
+
+    return (
+        qdcount == 1 and
+        flags & 0x7840 == 0 and
+        ancount + nscount + arcount <= 256 and
+        ord(data[12]) < 64
+    )
+
+
+def ip_fields(buff, linktype = 1):
+    """
+    Pull (version, proto, src, dst, sport, dport) straight out of a raw frame
+    without building dpkt objects. Addresses are packed bytes, ports are None
+    for anything but unfragmented TCP/UDP. Returns None for non-IP or truncated frames
+    """
+
+    located = locate_ip(buff, linktype)
+    if located is None:
+        return None
+
+    version, offset = located
+
+    header = ip_header(buff, version, offset)
+    if header is None:
+        return None
+
+    proto, src, dst, transport, end, first = header
+
+    if first and proto in (dpkt.ip.IP_PROTO_TCP, dpkt.ip.IP_PROTO_UDP) and len(buff) >= transport + 4:
+        sport, dport = struct.unpack_from('>HH', buff, transport)
+    else:
+        sport, dport = None, None
+
+    return version, proto, src, dst, sport, dport
+
+
+def shard_of(buff, shards, linktype = 1):
+    """
+    Cheaply map a raw frame to a shard without building dpkt objects
+
+    The hash covers both endpoints (address + port) in sorted order, so both
+    directions of a flow always land on the same shard. Anything we can't make
+    sense of goes to shard 0
+    """
+
+    if shards <= 1:
+        return 0
+
+    fields = ip_fields(buff, linktype)
+    if fields is None:
+        return 0
+
+    version, proto, src, dst, sport, dport = fields
+
+    if sport is not None:
+        src     +=  struct.pack('>H', sport)
+        dst     +=  struct.pack('>H', dport)
+
+    if src > dst:
+        src, dst = dst, src
+
+    return (zlib.crc32(src + dst) & 0xffffffff) % shards
+
+
+def _run_shard(args):
+    """
+    multiprocessing entry point for packetsummary.run(workers = N)
+    """
+    path, (rules, expression, start, end, stats), shard, shards = args
+    return packetsummary(path, rules, expression, start = start, end = end, stats = stats)._run_shard(shard, shards)
+
+
+def iter_captures(paths = None):
+    """
+    Expand a list of files and/or directories into capture paths
+    Directories are walked recursively, in sorted order
+    """
+
+    for path in paths:
+
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                yield os.path.join(root, name)
+
+
+# Batch worker's signatures and ResultCache, set up once per process by _init_worker
+_workerRules = None
+_workerCache = None
+
+
+def _init_worker(rules, cache):
+    global _workerRules, _workerCache
+
+    _workerRules = rules
+
+    if cache is not None:
+        _workerCache = ResultCache(cache)
+
+
+def _summarize(args):
+    """
+    Batch worker: summarize one capture and serialize it here, so the parent
+    only has to write the line out. Failures are reported rather than raised
+    """
+
+    path, expression, stats = args
+
+    # The summary's JSON goes in as is; a cached one is never decoded at all
+    try:
+        line = '{{"path": {0}, "summary": {1}}}'.format(json.dumps(path), packetsummary(path, _workerRules, expression, stats = stats, cache = _workerCache).run_json())
+    except Exception as e:
+        line = json.dumps({'path' : path, 'error' : str(e)})
+
+    return line
+
+
+def batch(paths = None, output = None, workers = None, signatures = None, packet_filter = None, stats = False, cache = None):
+    """
+    Summarize many captures across a pool of long-lived worker processes,
+    writing one JSON document per line to output as each capture finishes
+
+    Workers are reused between captures, so interpreter startup, imports (dpkt and
+    friends) and the cache connection are paid once per worker rather than once per
+    pcap. Lines are written in completion order; returns the number of captures processed
+
+    cache is the path of a ResultCache database; each worker opens its own connection
+    """
+
+    if paths is None or output is None:
+        raise Exception("batch() needs a list of paths and an output file")
+
+    # Load (and validate) rules once; each worker gets the parsed set when it starts,
+    # and builds its matcher on the first capture rather than on every one
+    if isinstance(signatures, basestring):
+        signatures = SignatureSet(signatures)
+
+    # Fail on a bad filter here rather than once per capture
+    if packet_filter:
+        compile_filter(packet_filter)
+
+    # Create the tables once, before workers race to
+    if cache is not None:
+        ResultCache(cache).close()
+
+    pool    =   multiprocessing.Pool(workers, _init_worker, (signatures, cache))
+    count   =   0
+
+    try:
+        for line in pool.imap_unordered(_summarize, ((path, packet_filter, stats) for path in iter_captures(paths))):
+            output.write(line + "\n")
+            count += 1
+
+    finally:
+        pool.close()
+        pool.join()
+
+    return count
+
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Summarize the contents of a pcap")
+    parser.add_argument('path', nargs = '+', help = "pcap to summarize (or, with --batch, any number of pcaps and directories)")
+    parser.add_argument('--batch', action = 'store_true', help = "Summarize every capture given, one JSON document per line")
+    parser.add_argument('--output', help = "With --batch, write to this file instead of stdout")
+    parser.add_argument('--signatures', help = "Rules file of payload signatures to scan for (see signatures.py)")
+    parser.add_argument('--cache', help = "Keep summaries in this SQLite database; captures already summarized with the same options aren't parsed again (see resultcache.py)")
+    parser.add_argument('--filter', help = "Only analyze packets matching this BPF-like expression, eg: 'udp port 53 or tcp port 80 or 443' (see packetfilter.py)")
+    parser.add_argument('--start', type = float, help = "Skip records timestamped before this (epoch seconds)")
+    parser.add_argument('--end', type = float, help = "Stop at the first record timestamped after this (epoch seconds)")
+    parser.add_argument('--checkpoint', help = "Resume from (and save progress to) this file, so a growing capture is only read once")
+    parser.add_argument('--stats', action = 'store_true', help = "Add per protocol counts, decode failures and dissector timings to the summary")
+    parser.add_argument('--prometheus', help = "Write those stats to this file in Prometheus text format (implies --stats)")
+    parser.add_argument('--columnar', help = "Write the summary to this file in the compact columnar format (see columnar.py) instead of printing JSON")
+    parser.add_argument('--ndjson', action = 'store_true', help = "Stream one JSON event per line instead of a single summary document")
+    parser.add_argument('--flows', action = 'store_true', help = "With --ndjson, also emit one tcp/udp event per flow at the end of the capture")
+    parser.add_argument('--workers', type = int, help = "Shard the capture by flow across this many processes (with --batch: pool size, defaults to one per CPU)")
+    args = parser.parse_args()
+
+    if args.batch:
+        if args.checkpoint or args.start is not None or args.end is not None or args.prometheus or args.columnar:
+            parser.error("--checkpoint, --start, --end, --prometheus and --columnar work on a single capture")
+
+        output = open(args.output, 'w') if args.output else sys.stdout
+        try:
+            batch(args.path, output, args.workers, args.signatures, args.filter, args.stats, args.cache)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        sys.exit(0)
+
+    if len(args.path) > 1:
+        parser.error("Multiple captures need --batch")
+
+    cache   = ResultCache(args.cache) if args.cache else None
+    summary = packetsummary(args.path[0], args.signatures, args.filter, args.checkpoint, args.start, args.end, args.stats or bool(args.prometheus), cache)
 
-    t = summary.run()
+    if args.columnar:
+        if args.ndjson or (args.workers or 1) > 1:
+            parser.error("--columnar is written by a single streaming pass (no --ndjson or --workers)")
+        summary.write_columnar(args.columnar)
 
-    print(json.dumps(t))
+    elif args.ndjson:
+        for event in summary.iter_events(connections = args.flows):
+            sys.stdout.write(json.dumps(event._asdict()) + "\n")
 
+    else:
+        print(summary.run_json(workers = args.workers or 1))
 
+    if args.prometheus:
+        with open(args.prometheus, 'w') as handle:
+            handle.write(summary.stats.prometheus())
 
+    if cache is not None:
+        cache.close()
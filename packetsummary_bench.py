@@ -0,0 +1,476 @@
+#! /usr/bin/env python2.7
+#
+#   packetsummary_bench.py
+#
+#   Benchmarks for packetsummary.py. Writes synthetic captures for a handful of
+#   traffic profiles, times full runs over each (packets/sec, MB/sec) and breaks
+#   one pass down by stage. Results are saved as JSON so runs from different
+#   versions can be compared:
+#
+#       python packetsummary_bench.py --output before.json
+#       ... change things ...
+#       python packetsummary_bench.py --output after.json --compare before.json
+#
+#   Captures are generated from a fixed seed, so the same --packets always means
+#   the same bytes. Stage times are inclusive (_parse_tcp includes the HTTP parse
+#   it triggers) and are taken on a separate pass, so wrapper overhead doesn't
+#   leak into the throughput numbers
+
+# Requirements
+import dpkt
+
+# Local
+import packetsummary
+
+# Standard Lib
+import os
+import sys
+import json
+import time
+import random
+import socket
+import struct
+import platform
+import tempfile
+import subprocess
+import timeit
+
+
+BENCH_VERSION   =   1
+
+# What the per-stage breakdown times
+STAGES          =   ['_parse_tcp', '_parse_udp', '_udp_parse_dns', '_tcp_parse_http', '_convert_string_to_printable']
+
+TH_DATA         =   dpkt.tcp.TH_ACK | dpkt.tcp.TH_PUSH
+
+
+##
+### Frame building
+
+def _frame(src, dst, proto, transport):
+    """
+    Wrap a dpkt TCP/UDP object in IPv4 and Ethernet, return the raw bytes
+    """
+
+    ip = dpkt.ip.IP(src = socket.inet_aton(src), dst = socket.inet_aton(dst), p = proto, ttl = 64, data = transport)
+    ip.len = len(str(ip))
+
+    return str(dpkt.ethernet.Ethernet(src = '\x02\x00\x00\x00\x00\x01', dst = '\x02\x00\x00\x00\x00\x02', type = dpkt.ethernet.ETH_TYPE_IP, data = ip))
+
+
+def _udp(src, dst, sport, dport, data):
+    udp = dpkt.udp.UDP(sport = sport, dport = dport, data = data)
+    udp.ulen = len(str(udp))
+    return _frame(src, dst, dpkt.ip.IP_PROTO_UDP, udp)
+
+
+def _address(rng, prefix):
+    return "{0}.{1}.{2}".format(prefix, rng.randint(0, 255), rng.randint(1, 254))
+
+
+def _bytes(rng, n):
+    return ''.join(chr(rng.getrandbits(8)) for i in range(n))
+
+
+class _Session(object):
+    """
+    Both directions of one TCP connection, with sequence numbers kept in step
+    """
+
+    def __init__(self, rng, client, server, sport, dport):
+        self.client     =   client
+        self.server     =   server
+        self.sport      =   sport
+        self.dport      =   dport
+        self.seq        =   [rng.randint(0, 0xffffffff), rng.randint(0, 0xffffffff)]
+
+    def send(self, data = '', reverse = False, flags = TH_DATA):
+        """
+        One segment, client -> server (or server -> client if reverse)
+        """
+
+        d = 1 if reverse else 0
+        src, dst, sport, dport = (self.server, self.client, self.dport, self.sport) if reverse else (self.client, self.server, self.sport, self.dport)
+
+        tcp = dpkt.tcp.TCP(sport = sport, dport = dport, seq = self.seq[d], flags = flags, win = 65535, data = data)
+        self.seq[d] = (self.seq[d] + len(data) + (1 if flags & (dpkt.tcp.TH_SYN | dpkt.tcp.TH_FIN) else 0)) & 0xffffffff
+
+        return _frame(src, dst, dpkt.ip.IP_PROTO_TCP, tcp)
+
+    def open(self):
+        return [self.send('', False, dpkt.tcp.TH_SYN), self.send('', True, dpkt.tcp.TH_SYN | dpkt.tcp.TH_ACK)]
+
+    def close(self):
+        return [self.send('', False, dpkt.tcp.TH_FIN | dpkt.tcp.TH_ACK), self.send('', True, dpkt.tcp.TH_FIN | dpkt.tcp.TH_ACK)]
+
+
+def _segments(session, data, reverse = False, mss = 1448):
+    return [session.send(data[i:i + mss], reverse) for i in range(0, len(data), mss)]
+
+
+##
+### Traffic profiles. Each yields lists of frames that belong together, forever
+
+def profile_http(rng):
+    """
+    Browsing: a GET per connection against a few dozen servers, 200 with a body
+    """
+
+    servers = [_address(rng, '93.184') for i in range(50)]
+    agents  = ['Mozilla/5.0 (Windows NT 10.0; Win64; x64)', 'curl/7.58.0', 'python-requests/2.22.0']
+
+    while True:
+        server  =   rng.choice(servers)
+        session =   _Session(rng, _address(rng, '10.1'), server, rng.randint(20000, 60000), 80)
+        path    =   '/' + '/'.join('p%d' % rng.randint(0, 999) for i in range(rng.randint(1, 4)))
+        body    =   ''.join(chr(rng.randint(32, 126)) for i in range(rng.randint(200, 4000)))
+
+        request =   "GET {0}?id={1} HTTP/1.1\r\nHost: {2}\r\nUser-Agent: {3}\r\nAccept: */*\r\n\r\n".format(path, rng.randint(0, 99999), server, rng.choice(agents))
+        reply   =   "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: {0}\r\n\r\n{1}".format(len(body), body)
+
+        yield session.open() + _segments(session, request) + _segments(session, reply, True) + session.close()
+
+
+def profile_dns(rng):
+    """
+    Resolver traffic: queries and answers for a few hundred names, so repeats are common
+    """
+
+    names = ['host{0}.{1}.example.{2}'.format(i, rng.choice(['cdn', 'www', 'api', 'mail']), rng.choice(['com', 'net', 'org'])) for i in range(500)]
+
+    while True:
+        name    =   rng.choice(names)
+        client  =   _address(rng, '10.2')
+        sport   =   rng.randint(1024, 65535)
+        qtype   =   rng.choice([dpkt.dns.DNS_A, dpkt.dns.DNS_A, dpkt.dns.DNS_AAAA])
+        ident   =   rng.randint(0, 0xffff)
+
+        query = dpkt.dns.DNS(id = ident, op = dpkt.dns.DNS_RD, qd = [dpkt.dns.DNS.Q(name = name, type = qtype)], an = [], ns = [], ar = [])
+
+        answer = dpkt.dns.DNS(id = ident, op = dpkt.dns.DNS_RD | dpkt.dns.DNS_RA, qd = query.qd, ns = [], ar = [])
+        answer.qr = dpkt.dns.DNS_R
+
+        # Answers are a function of the name, like a real resolver's would be
+        seed = random.Random(name)
+        if qtype == dpkt.dns.DNS_A:
+            answer.an = [dpkt.dns.DNS.RR(name = name, type = qtype, ttl = 300, rdata = struct.pack('>I', seed.getrandbits(32))) for i in range(seed.randint(1, 3))]
+        else:
+            answer.an = [dpkt.dns.DNS.RR(name = name, type = qtype, ttl = 300, rdata = struct.pack('>QQ', seed.getrandbits(64), seed.getrandbits(64)))]
+
+        yield [_udp(client, '10.2.0.53', sport, 53, str(query)), _udp('10.2.0.53', client, 53, sport, str(answer))]
+
+
+def _tls_record(content, body):
+    return struct.pack('>BHH', content, 0x0303, len(body)) + body
+
+
+def _tls_handshake(kind, body):
+    return _tls_record(22, struct.pack('>I', (kind << 24) | len(body)) + body)
+
+
+def _tls_extension(kind, body):
+    return struct.pack('>HH', kind, len(body)) + body
+
+
+def profile_tls(rng):
+    """
+    HTTPS: ClientHello with SNI, ServerHello, then application data both ways
+    """
+
+    names = ['www.site{0}.example'.format(i) for i in range(100)]
+    suites = [0x1301, 0x1302, 0xc02b, 0xc02f, 0xc02c, 0xc030, 0x009c, 0x002f]
+
+    while True:
+        name    =   rng.choice(names)
+        session =   _Session(rng, _address(rng, '10.3'), _address(rng, '151.101'), rng.randint(20000, 60000), 443)
+
+        sni     =   _tls_extension(0, struct.pack('>HBH', len(name) + 3, 0, len(name)) + name)
+        groups  =   _tls_extension(10, struct.pack('>H', 6) + struct.pack('>HHH', 29, 23, 24))
+        points  =   _tls_extension(11, '\x01\x00')
+        exts    =   sni + groups + points
+
+        hello   =   ('\x03\x03' + _bytes(rng, 32) + '\x00' + struct.pack('>H', len(suites) * 2) + struct.pack('>%dH' % len(suites), *suites) +
+                     '\x01\x00' + struct.pack('>H', len(exts)) + exts)
+
+        server  =   '\x03\x03' + _bytes(rng, 32) + '\x00' + struct.pack('>H', rng.choice(suites)) + '\x00' + struct.pack('>H', 0)
+
+        frames  =   session.open()
+        frames  +=  _segments(session, _tls_handshake(1, hello))
+        frames  +=  _segments(session, _tls_handshake(2, server), True)
+
+        for i in range(rng.randint(1, 6)):
+            frames += _segments(session, _tls_record(23, _bytes(rng, rng.randint(100, 1400))), i % 2 == 1)
+
+        yield frames + session.close()
+
+
+def profile_scan(rng):
+    """
+    Horizontal scan: SYNs from one host across many hosts and ports, the odd RST back
+    """
+
+    scanner = '10.4.0.66'
+    ports   = [21, 22, 23, 25, 80, 110, 139, 443, 445, 3306, 3389, 8080]
+
+    while True:
+        session = _Session(rng, scanner, _address(rng, '172.20'), rng.randint(30000, 60000), rng.choice(ports))
+        frames  = [session.send('', False, dpkt.tcp.TH_SYN)]
+
+        if rng.random() < 0.3:
+            frames.append(session.send('', True, dpkt.tcp.TH_RST | dpkt.tcp.TH_ACK))
+
+        yield frames
+
+
+def profile_stratum(rng):
+    """
+    Cryptominers: subscribe and authorize, then a stream of jobs and shares
+    """
+
+    pools = [_address(rng, '45.76') for i in range(5)]
+
+    while True:
+        session =   _Session(rng, _address(rng, '10.5'), rng.choice(pools), rng.randint(20000, 60000), 3333)
+        frames  =   session.open()
+
+        frames.append(session.send('{"id": 1, "method": "mining.subscribe", "params": ["cpuminer/2.5.0"]}\n'))
+        frames.append(session.send('{"id": 1, "result": [[["mining.notify", "ae6812eb4cd7735a"]], "08000002", 4], "error": null}\n', True))
+        frames.append(session.send('{"method": "mining.authorize", "params": ["wallet%d.rig%d", "x"], "id": 2}\n' % (rng.randint(0, 99), rng.randint(0, 9))))
+
+        for i in range(rng.randint(2, 10)):
+            job = '%08x' % rng.getrandbits(32)
+            frames.append(session.send('{"params": ["%s", "%064x", "01000000", "00", [], "00000002", "1c2ac4af", "504e86b9", false], "id": null, "method": "mining.notify"}\n' % (job, rng.getrandbits(256)), True))
+            frames.append(session.send('{"params": ["wallet", "%s", "00000000", "504e86ed", "%08x"], "id": %d, "method": "mining.submit"}\n' % (job, rng.getrandbits(32), i + 4)))
+
+        yield frames + session.close()
+
+
+PROFILES        =   {
+    'http'      :   profile_http,
+    'dns'       :   profile_dns,
+    'tls'       :   profile_tls,
+    'scan'      :   profile_scan,
+    'stratum'   :   profile_stratum,
+}
+
+
+def generate(name = None, path = None, packets = 20000, seed = 0):
+    """
+    Write (at least) packets frames of a traffic profile to a pcap at path
+    Returns (packets, bytes) actually written
+    """
+
+    rng     =   random.Random('{0}:{1}'.format(name, seed))
+    stamp   =   1500000000.0
+    count   =   0
+    size    =   0
+
+    with open(path, 'wb') as handle:
+        writer = dpkt.pcap.Writer(handle)
+
+        for frames in PROFILES[name](rng):
+            for frame in frames:
+                stamp += rng.random() * 0.002
+                writer.writepkt(frame, stamp)
+                count += 1
+                size += len(frame)
+
+            if count >= packets:
+                break
+
+    return count, size
+
+
+##
+### Measurement
+
+def time_stages(path = None, stages = STAGES):
+    """
+    One pass with every stage wrapped. Returns {stage: {'calls', 'seconds'}} and the pass total
+    """
+
+    summary =   packetsummary.packetsummary(path)
+    stats   =   packetsummary.Stats()
+
+    # Instance attributes shadow the methods, so internal self._x() calls go through them too
+    for name in stages:
+        setattr(summary, name, stats.timed(name, getattr(summary, name)))
+
+    tallies =   stats.dissectors
+
+    started =   timeit.default_timer()
+    summary.run()
+    total   =   timeit.default_timer() - started
+
+    return dict((name, {'calls' : calls, 'seconds' : seconds, 'share' : seconds / total if total else 0.0}) for name, (calls, seconds) in tallies.iteritems()), total
+
+
+def time_run(path = None, repeat = 3, workers = 1):
+    """
+    Best wall time of repeat full runs
+    """
+
+    best = None
+
+    for i in range(repeat):
+        started = timeit.default_timer()
+        packetsummary.packetsummary(path).run(workers = workers)
+        elapsed = timeit.default_timer() - started
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def cprofile(path = None, output = None):
+    """
+    Save cProfile stats for one run, for a closer look with pstats or snakeviz
+    """
+
+    import cProfile
+
+    summary = packetsummary.packetsummary(path)
+    cProfile.runctx('summary.run()', {}, {'summary' : summary}, output)
+
+
+def _revision():
+    """
+    Commit we're benchmarking, if we're in a git checkout
+    """
+
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = here, stderr = open(os.devnull, 'w')).strip()
+    except(OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(profiles = None, packets = 20000, repeat = 3, workers = 1, directory = None, profile_dir = None):
+    """
+    Generate and time every profile, return the machine readable results
+    """
+
+    results = {
+        'bench_version' :   BENCH_VERSION,
+        'created'       :   time.time(),
+        'revision'      :   _revision(),
+        'python'        :   platform.python_version(),
+        'dpkt'          :   getattr(dpkt, '__version__', None),
+        'platform'      :   platform.platform(),
+        'packets'       :   packets,
+        'repeat'        :   repeat,
+        'workers'       :   workers,
+        'profiles'      :   {},
+    }
+
+    for name in profiles or sorted(PROFILES):
+        path = os.path.join(directory, '{0}.pcap'.format(name))
+        count, size = generate(name, path, packets)
+
+        seconds = time_run(path, repeat, workers)
+        stages, total = time_stages(path)
+
+        results['profiles'][name] = {
+            'packets'           :   count,
+            'bytes'             :   size,
+            'seconds'           :   seconds,
+            'packets_per_sec'   :   count / seconds,
+            'mb_per_sec'        :   size / seconds / 1048576,
+            'instrumented'      :   total,
+            'stages'            :   stages,
+        }
+
+        if profile_dir is not None:
+            cprofile(path, os.path.join(profile_dir, '{0}.pstats'.format(name)))
+
+    return results
+
+
+def compare(current = None, baseline = None, tolerance = 0.1):
+    """
+    Per profile throughput change against an earlier results file
+    Returns [(profile, old pkt/s, new pkt/s, change)], and whether anything slowed down by more than tolerance
+    """
+
+    rows        =   []
+    regressed   =   False
+
+    for name, now in sorted(current['profiles'].iteritems()):
+        before = baseline.get('profiles', {}).get(name)
+        if before is None:
+            continue
+
+        change = now['packets_per_sec'] / before['packets_per_sec'] - 1
+        rows.append((name, before['packets_per_sec'], now['packets_per_sec'], change))
+
+        if change < -tolerance:
+            regressed = True
+
+    return rows, regressed
+
+
+def report(results = None, out = sys.stderr):
+    """
+    Human readable summary of a results dict
+    """
+
+    for name, p in sorted(results['profiles'].iteritems()):
+        out.write("{0:<8} {1:>7} pkts  {2:>9.0f} pkt/s  {3:>7.2f} MB/s\n".format(name, p['packets'], p['packets_per_sec'], p['mb_per_sec']))
+
+        for stage, t in sorted(p['stages'].iteritems(), key = lambda s: -s[1]['seconds']):
+            if t['calls']:
+                out.write("         {0:<30} {1:>7} calls  {2:>8.3f}s  {3:>5.1f}%\n".format(stage, t['calls'], t['seconds'], t['share'] * 100))
+
+
+
+if __name__ == "__main__":
+    import argparse
+    import shutil
+
+    parser = argparse.ArgumentParser(description = "Benchmark packetsummary against synthetic captures")
+    parser.add_argument('--profiles', help = "Comma separated subset of: {0}".format(', '.join(sorted(PROFILES))))
+    parser.add_argument('--packets', type = int, default = 20000, help = "Packets per generated capture")
+    parser.add_argument('--repeat', type = int, default = 3, help = "Timed runs per profile, the best is kept")
+    parser.add_argument('--workers', type = int, default = 1, help = "Passed through to packetsummary.run()")
+    parser.add_argument('--output', help = "Write results as JSON here (default: stdout)")
+    parser.add_argument('--compare', help = "Earlier results file to compare packets/sec against")
+    parser.add_argument('--tolerance', type = float, default = 0.1, help = "With --compare, exit non-zero if any profile is this much slower")
+    parser.add_argument('--keep', help = "Write the generated captures to this directory and keep them")
+    parser.add_argument('--cprofile', help = "Also save cProfile stats per profile to this directory")
+    args = parser.parse_args()
+
+    profiles = args.profiles.split(',') if args.profiles else None
+    for name in profiles or []:
+        if name not in PROFILES:
+            parser.error("Unknown profile {0}".format(name))
+
+    for path in (args.keep, args.cprofile):
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+    directory = args.keep or tempfile.mkdtemp(prefix = 'packetsummary_bench')
+
+    try:
+        results = benchmark(profiles, args.packets, args.repeat, args.workers, directory, args.cprofile)
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors = True)
+
+    report(results)
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent = 2, sort_keys = True)
+    else:
+        print(json.dumps(results, indent = 2, sort_keys = True))
+
+    if args.compare:
+        with open(args.compare, 'r') as handle:
+            rows, regressed = compare(results, json.load(handle), args.tolerance)
+
+        for name, before, now, change in rows:
+            sys.stderr.write("{0:<8} {1:>9.0f} -> {2:>9.0f} pkt/s  {3:+.1%}\n".format(name, before, now, change))
+
+        if regressed:
+            sys.exit(1)
@@ -7,73 +7,179 @@
 #       Description: See http://php.net/manual/en/function.print-r.php for a crash-course
 #       This code attempts to print in nice, human-readable format Lists and Dictionaries
 #
+#       Rendering walks an explicit stack rather than recursing, so nesting depth is only
+#       limited by memory, and lines are written to output (stdout by default) in batches.
+#       max_depth and max_items cut huge structures short; a container that contains
+#       itself is shown as *RECURSION* (as PHP does) instead of looping forever
+#
+#       iter_print_r() yields the same lines one at a time, rendering only as far as it's
+#       read, and page_r() feeds them to a pager, so the first screen of a multi-million
+#       entry list shows up straight away
+#
+
+import os
+import sys
+import errno
+import subprocess
+from itertools import islice
+
+INDENT          =   "      "
+ARROW           =   " =>      "
+
+# Lines are joined and written this many at a time
+BUFFER_LINES    =   1024
+
+# Dict keys are aligned on the widest key within each run of this many children,
+# so nothing needs a pass over the whole container before its first line
+ALIGN_WINDOW    =   256
+
+# page_r() shows this many children of each container by default
+PAGE_ITEMS      =   100
+
+
+def _children(haystack, max_items):
+    """
+    (key, value, key width) for each child we'll show, lazily
+    """
+
+    # List keys are just indexes, so the widest is the last one shown
+    if isinstance(haystack, list):
+        shown = len(haystack) if max_items is None else min(len(haystack), max_items)
+        width = len(str(shown - 1)) if shown else 0
+
+        for index, value in enumerate(islice(haystack, shown)):
+            yield index, value, width
+        return
+
+    items = haystack.iteritems()
+    if max_items is not None:
+        items = islice(items, max_items)
+
+    while True:
+        window = list(islice(items, ALIGN_WINDOW))
+        if not window:
+            return
+
+        width = max(len(str(k)) for k, v in window)
+        for key, value in window:
+            yield key, value, width
+
+
+def print_r(haystack, depth=0, inline=False, inline_key=0, inline_max_key=0, output=None, max_depth=None, max_items=None):
+
+    output  = output or sys.stdout
+    lines   = []
+
+    for line in iter_print_r(haystack, depth, inline, inline_key, inline_max_key, max_depth, max_items):
+        lines.append(line + "\n")
+        if len(lines) >= BUFFER_LINES:
+            output.write(''.join(lines))
+            del lines[:]
 
-def print_r(haystack, depth=0, inline=False, inline_key=0, inline_max_key=0):
+    if lines:
+        output.write(''.join(lines))
+
+
+def page_r(haystack, max_items=PAGE_ITEMS, max_depth=None, pager=None):
+    """
+    Show haystack through a pager ($PAGER, or less), first max_items children of each container
+    Lines are rendered as the pager asks for them, and quitting the pager stops the rendering
+    Without a terminal, this is just print_r
+    """
+
+    if not sys.stdout.isatty():
+        print_r(haystack, max_depth=max_depth, max_items=max_items)
+        return
+
+    proc = subprocess.Popen(pager or os.environ.get('PAGER') or 'less', shell=True, stdin=subprocess.PIPE, bufsize=-1)
+
+    try:
+        for line in iter_print_r(haystack, max_depth=max_depth, max_items=max_items):
+            proc.stdin.write(line + "\n")
+
+    # The pager was quit early
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+
+    finally:
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        proc.wait()
+
+
+def iter_print_r(haystack, depth=0, inline=False, inline_key=0, inline_max_key=0, max_depth=None, max_items=None):
+    """
+    print_r's lines (without newlines), one at a time
+    """
+
+    def label(key, width):
+        return "[" + str(key) + "] " + str(" " * (width - len(str(key)))) + ARROW
 
     # Give our first open bracket, depending on what haystack is...
     if isinstance(haystack, dict) and depth == 0:
-        print "Dictionary\n{"
+        yield "Dictionary"
 
     if isinstance(haystack, list) and depth == 0:
-        print "List\n["
+        yield "List"
 
+    if not isinstance(haystack, (dict, list)):
+        return
 
-    # These two IFs check to see if the function is being called from within a routine.. if so, output information accordingly
-    if isinstance(haystack, dict) and inline == True:
-        print ("      "*(depth))+"["+str(inline_key)+"] "+str(" "*(inline_max_key-len(str(inline_key))))+" =>      DICT()"
-        print ("      "*(depth))+"{"
+    # Each frame is (children, depth, closing bracket, container, child indent); path
+    # holds the ids of the containers we're inside of
+    stack   = []
+    path    = set()
 
-    if isinstance(haystack, list) and inline == True:
-        print ("      "*(depth))+"["+str(inline_key)+"] "+str(" "*(inline_max_key-len(str(inline_key))))+" =>      LIST()"
-        print ("      "*(depth))+"["
+    container, d, inline, key, width = haystack, depth, inline, inline_key, inline_max_key
 
+    while True:
 
-    ## Dictionary
-    #       Returns a tuple for each row. Break it up into keypair and do magic with it
-    if isinstance(haystack, dict):
+        # Open a container
+        if container is not None:
+            kind, opener, closer = ("DICT()", "{", "}") if isinstance(container, dict) else ("LIST()", "[", "]")
 
-        # How many keys are we working with?
-        if len(haystack) <= 0:
-            max_key = 0
-        else:
-            max_key = max(len(str(k)) for k in haystack.iterkeys())
+            # Called from within a routine.. output information accordingly
+            if inline:
+                yield (INDENT * d) + label(key, width) + kind
 
-        # Traverse (at only the "top" level) the dictionary
-        for count, keyValue in enumerate(haystack.iteritems()):
+            yield (INDENT * d) + opener
 
-            # Split our tuple up into a key and a value
-            key, value = keyValue
+            stack.append((_children(container, max_items), d, closer, container, INDENT * (d + 1)))
+            path.add(id(container))
+            container = None
 
-            # Basic logic from here out...
-            if isinstance(value, dict) or isinstance(value, list):
+        if not stack:
+            return
 
-                print_r(value, depth+1, True, key, max_key)
+        items, d, closer, parent, indent = stack[-1]
 
-            else:
+        try:
+            key, value, width = next(items)
 
-                print ("      "*(depth+1))+"["+str(key)+"] "+str(" "*(max_key-len(str(key))))+" =>      "+str(value)
+        # Out of children: count anything we skipped, then print our closing bracket
+        except StopIteration:
+            if max_items is not None and len(parent) > max_items:
+                yield indent + "... {0} more ({1} total)".format(len(parent) - max_items, len(parent))
+            yield (INDENT * d) + closer
+            path.discard(id(parent))
+            stack.pop()
+            continue
 
-        # Print our closing bracket
-        print ("      "*(depth))+"}"
+        # Basic logic from here out...
+        if isinstance(value, (dict, list)):
 
-    ## Lists
-    #       Returns a tuple for each row in the list with a numerical key
-    if isinstance(haystack, list):
+            if id(value) in path:
+                yield indent + label(key, width) + ("DICT()" if isinstance(value, dict) else "LIST()") + " *RECURSION*"
 
-        # How many keys are in the shit?
-        if len(haystack) <= 0:
-            max_key = 0
-        else:
-            max_key = len(max(haystack))
-
-        # traverse our dictionary
-        for count, keyValue in enumerate(haystack):
-
-            if isinstance(keyValue, dict) or isinstance(keyValue, list):
-                print_r(keyValue, depth+1, True, count, max_key)
+            elif max_depth is not None and d + 1 > max_depth:
+                yield indent + label(key, width) + ("DICT()" if isinstance(value, dict) else "LIST()") + " ({0} items not shown)".format(len(value))
 
             else:
-                print ("      "*(depth+1))+"["+str(count)+"] "+str(" "*(max_key-len(str(count))))+" =>      "+str(keyValue)
+                container, d, inline = value, d + 1, True
 
-
-        print("      "*(depth))+"]"
+        else:
+            key = str(key)
+            yield indent + "[" + key + "] " + " " * (width - len(key)) + ARROW + str(value)
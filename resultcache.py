@@ -0,0 +1,234 @@
+#! /usr/bin/env python2.7
+#
+#   resultcache.py
+#
+#   An on-disk, content addressed cache of analysis results (SQLite), so that
+#   re-submitting a sample or capture we've already seen costs a stat() and a
+#   lookup rather than a full parse.
+#
+#   Two tables:
+#
+#       files       path -> (size, mtime, digest). A file we've seen before, unchanged,
+#                   is resolved to its digest without reading it
+#       results     (digest, kind) -> (version, result). The same content under a
+#                   new name is only hashed once, then hits here. str results (eg: JSON
+#                   text) are stored and handed back as they are; anything else is pickled
+#
+#   kind names the analysis and the options that shape its output, eg 'pe-header'
+#   or 'packetsummary:<options hash>'. version is the caller's parser version: bump it
+#   and every entry written by the old parser reads as a miss. Entries are evicted
+#   least recently used first once the stored results pass max_bytes.
+#
+#   eg:
+#       cache = ResultCache('results.db')
+#       info  = cache.cached(path, 'pe-header', 1, lambda: parsePE(path))
+
+# Standard Lib
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import cPickle as pickle
+
+
+# Bump when the tables change; older databases are dropped and rebuilt
+SCHEMA_VERSION  =   2
+
+DEFAULT_SIZE    =   512 * 1024 * 1024
+HASH_BLOCK      =   1024 * 1024
+
+# Hits only refresh an entry's LRU time if it's older than this, so reads stay reads
+TOUCH_INTERVAL  =   60
+
+
+def file_digest(path = None):
+    """
+    SHA-256 of a file's contents, read in blocks
+    """
+
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as handle:
+        while True:
+            block = handle.read(HASH_BLOCK)
+            if not block:
+                break
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Cache results of expensive per-file analysis on disk, keyed on content
+    Safe to share between threads; separate processes should each open their own
+    Raises an exception if the database can't be opened
+    """
+
+    def __init__(self, path = None, max_bytes = DEFAULT_SIZE):
+
+        if path == None:
+            raise Exception("No path to a cache database specified")
+
+        try:
+            self.db         =   sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        except sqlite3.Error as e:
+            raise Exception("Unable to open cache {0}: {1}".format(path, e))
+
+        self.path           =   path
+        self.maxBytes       =   max_bytes
+        self.lock           =   threading.Lock()
+
+        # Cheap counters, for whoever wants to know how well we're doing
+        self.hits           =   0
+        self.misses         =   0
+
+        with self.lock:
+            self._setup()
+
+            # Running (over)estimate of stored bytes, so puts don't sum the table.
+            # Other processes sharing the database are only noticed when we re-sum
+            self.total      =   self._stored()
+
+    def _setup(self):
+
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self.db.executescript("""
+                DROP TABLE IF EXISTS files;
+                DROP TABLE IF EXISTS results;
+                PRAGMA user_version = {0};
+            """.format(SCHEMA_VERSION))
+
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS files (
+                path    TEXT PRIMARY KEY,
+                size    INTEGER,
+                mtime   REAL,
+                digest  TEXT
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                digest  TEXT,
+                kind    TEXT,
+                version TEXT,
+                value   BLOB,
+                pickled INTEGER,
+                size    INTEGER,
+                used    REAL,
+                PRIMARY KEY (digest, kind)
+            );
+            CREATE INDEX IF NOT EXISTS results_used ON results (used);
+        """)
+        self.db.commit()
+
+    def _stored(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+    def digest(self, path = None):
+        """
+        Content digest of path, from the files table if the file hasn't changed since
+        we last hashed it
+        """
+
+        path    = os.path.realpath(path)
+        st      = os.stat(path)
+
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, digest FROM files WHERE path = ?', (path,)).fetchone()
+
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime:
+            return row[2]
+
+        digest = file_digest(path)
+
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (path, st.st_size, st.st_mtime, digest))
+            self.db.commit()
+
+        return digest
+
+    def get(self, digest = None, kind = None, version = None):
+        """
+        (True, result) on a hit, (False, None) on a miss or a stale version
+        """
+
+        with self.lock:
+            row = self.db.execute('SELECT version, value, pickled, used FROM results WHERE digest = ? AND kind = ?', (digest, kind)).fetchone()
+
+            if row is None or row[0] != str(version):
+                self.misses += 1
+                return False, None
+
+            now = time.time()
+            if now - row[3] > TOUCH_INTERVAL:
+                self.db.execute('UPDATE results SET used = ? WHERE digest = ? AND kind = ?', (now, digest, kind))
+                self.db.commit()
+
+            self.hits += 1
+
+        value = str(row[1])
+        return True, pickle.loads(zlib.decompress(value)) if row[2] else value
+
+    def put(self, digest = None, kind = None, version = None, value = None):
+        """
+        Store a result, then evict least recently used entries past max_bytes
+        """
+
+        pickled = not isinstance(value, str)
+        blob    = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) if pickled else value
+
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (digest, kind, str(version), sqlite3.Binary(blob), pickled, len(blob), time.time()))
+            self.total += len(blob)
+
+            if self.total > self.maxBytes:
+                self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        total = self.total = self._stored()
+        if total <= self.maxBytes:
+            return
+
+        doomed = []
+        for digest, kind, size in self.db.execute('SELECT digest, kind, size FROM results ORDER BY used'):
+            if total <= self.maxBytes:
+                break
+            doomed.append((digest, kind))
+            total -= size
+
+        self.db.executemany('DELETE FROM results WHERE digest = ? AND kind = ?', doomed)
+        self.total = total
+
+        # Forget hashes nothing refers to any more
+        self.db.execute('DELETE FROM files WHERE digest NOT IN (SELECT digest FROM results)')
+
+    def cached(self, path = None, kind = None, version = None, compute = None):
+        """
+        compute()'s result for path, from the cache if we have it
+        """
+
+        digest = self.digest(path)
+
+        found, value = self.get(digest, kind, version)
+        if found:
+            return value
+
+        value = compute()
+        self.put(digest, kind, version, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM results')
+            self.db.execute('DELETE FROM files')
+            self.db.commit()
+            self.total = 0
+
+    def close(self):
+        with self.lock:
+            self.db.close()
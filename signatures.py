@@ -0,0 +1,204 @@
+#! /usr/bin/env python2.7
+#
+#   signatures.py
+#
+#   Payload signatures for packetsummary. Every rule's literals are compiled into
+#   one automaton, so a payload is scanned once no matter how many rules are loaded.
+#   Only rules whose literal actually shows up pay for their regex.
+#
+#   Uses pyahocorasick (https://pypi.org/project/pyahocorasick/) when it's installed,
+#   otherwise falls back to a single alternation regex built from the same literals.
+#
+#   Rules file (ini style, one section per rule):
+#
+#       [stratum-authorize]
+#       literals    =   mining.authorize
+#       regex       =   ^\{"method": "mining.authorize".*\["(.*)", "(.*)"\]
+#       protocol    =   tcp
+#       description =   Stratum miner login
+#
+#   literals        One or more (one per line), \xNN escapes allowed. Required
+#   regex           Optional. Searched over the payload once a literal hits, so
+#                   anchor it with ^ if it should only match at the start
+#   protocol        tcp, udp or any (the default)
+#   description     Optional, copied into the results
+
+# Standard Lib
+import re
+import ConfigParser
+
+# Optional
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+PROTOCOLS       =   frozenset(['tcp', 'udp', 'any'])
+
+
+class Signature(object):
+    """
+    A single rule
+    """
+
+    __slots__ = ('name', 'literals', 'regex', 'protocol', 'description')
+
+    def __init__(self, name, literals, regex = None, protocol = 'any', description = None):
+        self.name           =   name
+        self.literals       =   literals
+        self.regex          =   re.compile(regex) if regex else None
+        self.protocol       =   protocol
+        self.description    =   description
+
+
+class SignatureSet(object):
+    """
+    A collection of Signatures, optionally loaded from a rules file
+    Raises an exception on malformed rules
+    """
+
+    def __init__(self, path = None):
+
+        self.rules          =   []
+
+        # Literal -> indexes of the rules it triggers
+        self._literals      =   {}
+        self._automaton     =   None
+
+        if path is not None:
+            self.load(path)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __getstate__(self):
+        """
+        Pickle rule definitions only (for worker pools), the automaton is rebuilt
+        """
+        return [(r.name, r.literals, r.regex.pattern if r.regex else None, r.protocol, r.description) for r in self.rules]
+
+    def __setstate__(self, state):
+        self.__init__()
+        for rule in state:
+            self.add(*rule)
+
+    def load(self, path = None):
+        """
+        Add every rule in an ini style rules file
+        """
+
+        config = ConfigParser.RawConfigParser()
+
+        try:
+            with open(path, 'r') as handle:
+                config.readfp(handle)
+        except(IOError, OSError):
+            raise Exception("Unable to read signatures from {0}".format(path))
+        except ConfigParser.Error as e:
+            raise Exception("Bad signatures file {0}: {1}".format(path, e))
+
+        for name in config.sections():
+            get = lambda key, default = None: config.get(name, key) if config.has_option(name, key) else default
+
+            literals = [l.strip().decode('string_escape') for l in get('literals', '').splitlines() if l.strip()]
+
+            self.add(name, literals, get('regex'), get('protocol', 'any'), get('description'))
+
+    def add(self, name = None, literals = None, regex = None, protocol = 'any', description = None):
+        """
+        Add a single rule
+        """
+
+        if not literals:
+            raise Exception("Signature {0} needs at least one literal".format(name))
+
+        if protocol not in PROTOCOLS:
+            raise Exception("Signature {0} has an unknown protocol ({1})".format(name, protocol))
+
+        try:
+            rule = Signature(name, list(literals), regex, protocol, description)
+        except re.error as e:
+            raise Exception("Signature {0} has a bad regex: {1}".format(name, e))
+
+        for literal in rule.literals:
+            self._literals.setdefault(literal, []).append(len(self.rules))
+
+        self.rules.append(rule)
+        self._automaton = None
+
+    def _build(self):
+        """
+        Compile every literal into one automaton
+        """
+
+        if ahocorasick is not None:
+            automaton = ahocorasick.Automaton()
+            for literal, rules in self._literals.iteritems():
+                automaton.add_word(literal, rules)
+            automaton.make_automaton()
+
+            self._automaton = automaton
+            return
+
+        # Fallback: one zero-width alternation, longest literals first. At any
+        # position only the longest literal matches, so we also credit every
+        # shorter literal that is a prefix of it
+        literals    =   sorted(self._literals, key = len, reverse = True)
+        implied     =   {}
+
+        for literal in literals:
+            rules = set()
+            for other in literals:
+                if literal.startswith(other):
+                    rules.update(self._literals[other])
+            implied[literal] = sorted(rules)
+
+        self._automaton = (re.compile('(?=(' + '|'.join(re.escape(l) for l in literals) + '))', re.S), implied)
+
+    def _candidates(self, payload):
+        """
+        Indexes of rules with at least one literal in payload, from a single pass
+        """
+
+        if self._automaton is None:
+            self._build()
+
+        hits = set()
+
+        if ahocorasick is not None:
+            for end, rules in self._automaton.iter(payload):
+                hits.update(rules)
+        else:
+            regex, implied = self._automaton
+            for match in regex.finditer(payload):
+                hits.update(implied[match.group(1)])
+
+        return hits
+
+    def scan(self, payload = None, protocol = 'any'):
+        """
+        Return [(Signature, match)] for every rule that fires on payload, in rule
+        order. match is the regex match, or None for literal-only rules
+        """
+
+        if not self.rules or not payload:
+            return []
+
+        hits = []
+
+        for index in sorted(self._candidates(payload)):
+            rule = self.rules[index]
+
+            if rule.protocol != 'any' and protocol != 'any' and rule.protocol != protocol:
+                continue
+
+            if rule.regex is None:
+                hits.append((rule, None))
+                continue
+
+            match = rule.regex.search(payload)
+            if match:
+                hits.append((rule, match))
+
+        return hits
@@ -0,0 +1,58 @@
+#! /usr/bin/env python2.7
+#
+#   test_columnar.py
+#
+#   Round trips through ColumnarWriter / ColumnarFile. Run with: python -m unittest test_columnar
+
+# Standard Lib
+import os
+import shutil
+import tempfile
+import unittest
+
+from columnar import ColumnarWriter, ColumnarFile
+
+
+class ColumnarRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.directory  =   tempfile.mkdtemp()
+        self.path       =   os.path.join(self.directory, 'out.psc')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, rows, chunk_rows = 4):
+        writer = ColumnarWriter(self.path, chunk_rows)
+        for row in rows:
+            writer.append('t', row)
+        writer.close()
+        return ColumnarFile(self.path)
+
+    def test_int64_random_access(self):
+        values  = [0, 1, -1, 2 ** 31 - 1, 2 ** 31, 3000000000, 2 ** 40, -2 ** 40, 2 ** 63 - 1, -2 ** 63]
+        summary = self.write([{'n' : v} for v in values])
+
+        try:
+            for rows, columns in summary.table('t').chunks:
+                column = columns['n']
+                self.assertEqual([column[i] for i in range(len(column))], list(column))
+
+            self.assertEqual(list(summary.table('t').column('n')), values)
+            self.assertEqual(list(summary.table('t').rows_where('n', 3000000000)), [5])
+        finally:
+            summary.close()
+
+    def test_mixed_columns(self):
+        rows    = [{'a' : i, 'b' : 'x%d' % (i % 3)} if i % 5 else {'a' : 2.5 * i, 'c' : [i], 'd' : True} for i in range(23)]
+        summary = self.write(rows)
+
+        try:
+            self.assertEqual(list(summary.table('t')), rows)
+            self.assertEqual(list(summary.table('t').rows_where('b', 'x1')), [1, 4, 7, 13, 16, 19, 22])
+        finally:
+            summary.close()
+
+
+if __name__ == "__main__":
+    unittest.main()